@@ -4,14 +4,35 @@ from dotenv import load_dotenv
 import os
 import sys
 from audio_recorder_streamlit import audio_recorder
-import speech_recognition as sr
-import io
-from gtts import gTTS
-import base64
 import hashlib
+import json
+import re
+import copy
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # Import custom WebRTC component
 from components.continuous_voice_recorder import continuous_voice_recorder
+from services.audio import decode_for_recognition, playable_audio, recording_audio, sniff_format
+from services.context import SUMMARY_SYSTEM_PROMPT, ContextWindow, summarize_conversation
+from services.conversation import (
+    ConversationEngine,
+    build_system_prompt as build_personality_prompt,
+    chat_fingerprint,
+    chat_history,
+)
+from services.llm import RequestScheduler, ResponseCache, create_model
+from services.media import MediaStore
+from services.session_store import ConversationHistory, create_session_store
+from services.speech_text import normalize_for_speech
+from services.stt import IncrementalTranscriber, create_stt_engine
+from services.tracing import Tracer, start_metrics_server
+from services.tts import ChunkedSynthesizer, TTSCache, TTSJobQueue, create_tts_engine
+
+# Start of this script run, for the rerun latency span
+run_started = time.perf_counter()
 
 # Load environment variables
 load_dotenv()
@@ -82,6 +103,15 @@ PERSONALITIES = {
     }
 }
 
+# Messages rendered at once in the chat transcript, older ones load a page at a time
+TRANSCRIPT_PAGE_SIZE = int(os.getenv("TRANSCRIPT_PAGE_SIZE", "20"))
+
+# Session settings kept in the session store next to the messages, so they survive too
+PERSISTED_STATE = ("personality", "language", "last_language", "conversation_turns", "last_audio_hash")
+
+# Session ids accepted from the URL
+SESSION_ID = re.compile(r"[A-Za-z0-9_-]{8,64}")
+
 # Page configuration
 st.set_page_config(
     page_title="AI Chatbot",
@@ -89,244 +119,614 @@ st.set_page_config(
     layout="wide"
 )
 
+# Session state defaults, copied into each new session
+SESSION_DEFAULTS = {
+    "personality": "General Assistant",
+    "voice_text": "",
+    "last_audio_hash": None,
+    "auto_send_voice": False,
+    "show_edit": False,
+    "enable_voice_response": False,
+    "tts_audio": {},
+    "processing": False,
+    "language": "English",
+    "last_language": "English",
+    "conversation_flow_mode": False,
+    "conversation_turns": 0,
+    "show_continue_prompt": False,
+    "automatic_mode": False,
+    "auto_record_trigger": 0,
+    "stream_responses": True,
+    "autoplay_message_index": None,
+    "segment_transcribers": {},
+    "chat": None,
+    "chat_system_prompt": None,
+    "chat_synced": None,
+    "chat_summarized": 0,
+    "context_window": None,
+    "last_scroll": None,
+    "transcript_window": TRANSCRIPT_PAGE_SIZE,
+    "pending_turn": None,
+    "pending_turn_mode": None,
+    "pending_recording_url": None,
+    "speech_queue": None,
+}
+
+# Initialize session state
+for key, value in SESSION_DEFAULTS.items():
+    if key not in st.session_state:
+        # Copy so sessions never share a mutable default
+        st.session_state[key] = copy.deepcopy(value)
+
+# Conversations live in the session store, shared by every app process
+@st.cache_resource
+def get_session_store():
+    store = create_session_store(os.getenv("SESSION_STORE", "sqlite"))
+    # Forget conversations nobody has touched in a while (0 keeps them forever)
+    retention_days = float(os.getenv("SESSION_RETENTION_DAYS", "30"))
+    if retention_days > 0:
+        store.delete_expired(retention_days * 24 * 3600)
+    return store
+
+if "session_id" not in st.session_state:
+    # The session id is kept in the URL, so a reload, a restart or another process
+    # behind the load balancer picks the conversation back up
+    session_id = st.query_params.get("session", "")
+    if not SESSION_ID.fullmatch(session_id):
+        session_id = uuid.uuid4().hex[:12]
+        st.query_params["session"] = session_id
+    st.session_state.session_id = session_id
+    # Only the latest page of messages is read now, older ones when something needs them
+    st.session_state.messages = ConversationHistory(get_session_store(), session_id, page_size=TRANSCRIPT_PAGE_SIZE)
+    for key, value in get_session_store().load_state(session_id).items():
+        if key in PERSISTED_STATE:
+            st.session_state[key] = value
+    st.session_state.persisted_state = {key: st.session_state[key] for key in PERSISTED_STATE}
+
+# Save the persisted settings when they changed; called at the start and end of every
+# run, since most changes are followed by st.rerun()
+def save_session_state():
+    state = {key: st.session_state[key] for key in PERSISTED_STATE}
+    if state != st.session_state.persisted_state:
+        get_session_store().save_state(st.session_state.session_id, state)
+        st.session_state.persisted_state = state
+
+save_session_state()
+
 # Scroll to last AI response or voice input section
 import streamlit.components.v1 as components
 
 # Determine scroll target based on conversation flow mode
-scroll_target = "voice_input" if st.session_state.get("show_continue_prompt", False) else "assistant"
-
-components.html(
-    f"""
-    <script>
-        function scrollToTarget() {{
-            setTimeout(() => {{
-                const target = '{scroll_target}';
-
-                if (target === 'voice_input') {{
-                    // Scroll to voice input section
-                    const voiceSection = window.parent.document.evaluate(
-                        "//h3[contains(text(), 'Voice Input')]",
-                        window.parent.document,
-                        null,
-                        XPathResult.FIRST_ORDERED_NODE_TYPE,
-                        null
-                    ).singleNodeValue;
-
-                    if (voiceSection) {{
-                        voiceSection.scrollIntoView({{ behavior: 'smooth', block: 'center' }});
-                    }}
-                }} else {{
-                    // Scroll to last assistant message
-                    const messages = window.parent.document.querySelectorAll('[data-testid="stChatMessage"]');
-                    let lastAssistant = null;
-
-                    for (let i = messages.length - 1; i >= 0; i--) {{
-                        if (messages[i].querySelector('[data-testid="chatAvatarIcon-assistant"]')) {{
-                            lastAssistant = messages[i];
-                            break;
+scroll_target = "voice_input" if st.session_state.show_continue_prompt else "assistant"
+
+# Only inject the script when there is something new to scroll to
+scroll_state = (len(st.session_state.messages), scroll_target)
+if scroll_state != st.session_state.last_scroll:
+    st.session_state.last_scroll = scroll_state
+    components.html(
+        f"""
+        <script>
+            function scrollToTarget() {{
+                setTimeout(() => {{
+                    const target = '{scroll_target}';
+
+                    if (target === 'voice_input') {{
+                        // Scroll to voice input section
+                        const voiceSection = window.parent.document.evaluate(
+                            "//h3[contains(text(), 'Voice Input')]",
+                            window.parent.document,
+                            null,
+                            XPathResult.FIRST_ORDERED_NODE_TYPE,
+                            null
+                        ).singleNodeValue;
+
+                        if (voiceSection) {{
+                            voiceSection.scrollIntoView({{ behavior: 'smooth', block: 'center' }});
+                        }}
+                    }} else {{
+                        // Scroll to last assistant message
+                        const messages = window.parent.document.querySelectorAll('[data-testid="stChatMessage"]');
+                        let lastAssistant = null;
+
+                        for (let i = messages.length - 1; i >= 0; i--) {{
+                            if (messages[i].querySelector('[data-testid="chatAvatarIcon-assistant"]')) {{
+                                lastAssistant = messages[i];
+                                break;
+                            }}
                         }}
-                    }}
 
-                    if (lastAssistant) {{
-                        lastAssistant.scrollIntoView({{ behavior: 'smooth', block: 'start' }});
+                        if (lastAssistant) {{
+                            lastAssistant.scrollIntoView({{ behavior: 'smooth', block: 'start' }});
+                        }}
                     }}
-                }}
-            }}, 300);
-        }}
-
-        scrollToTarget();
-        window.addEventListener('load', scrollToTarget);
-    </script>
-    """,
-    height=0,
-)
-
-# Initialize session state
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-
-if "personality" not in st.session_state:
-    st.session_state.personality = "General Assistant"
-
-if "voice_text" not in st.session_state:
-    st.session_state.voice_text = ""
-
-if "last_audio_hash" not in st.session_state:
-    st.session_state.last_audio_hash = None
-
-if "auto_send_voice" not in st.session_state:
-    st.session_state.auto_send_voice = False
-
-if "show_edit" not in st.session_state:
-    st.session_state.show_edit = False
-
-if "enable_voice_response" not in st.session_state:
-    st.session_state.enable_voice_response = False
-
-if "tts_audio" not in st.session_state:
-    st.session_state.tts_audio = {}
-
-if "processing" not in st.session_state:
-    st.session_state.processing = False
-
-if "language" not in st.session_state:
-    st.session_state.language = "English"
-
-if "last_language" not in st.session_state:
-    st.session_state.last_language = "English"
-
-if "conversation_flow_mode" not in st.session_state:
-    st.session_state.conversation_flow_mode = False
-
-if "conversation_turns" not in st.session_state:
-    st.session_state.conversation_turns = 0
-
-if "show_continue_prompt" not in st.session_state:
-    st.session_state.show_continue_prompt = False
-
-if "automatic_mode" not in st.session_state:
-    st.session_state.automatic_mode = False
-
-if "auto_record_trigger" not in st.session_state:
-    st.session_state.auto_record_trigger = 0
-
-# Function to clean text for TTS
-def clean_text_for_speech(text):
-    """Remove unnecessary symbols and clean text for natural speech"""
-    import re
-
-    # Remove markdown formatting
-    text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)  # Bold **text**
-    text = re.sub(r'\*(.+?)\*', r'\1', text)  # Italic *text*
-    text = re.sub(r'__(.+?)__', r'\1', text)  # Bold __text__
-    text = re.sub(r'_(.+?)_', r'\1', text)  # Italic _text_
-    text = re.sub(r'`(.+?)`', r'\1', text)  # Code `text`
-    text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)  # Code blocks
-
-    # Remove markdown links but keep text: [text](url) -> text
-    text = re.sub(r'\[(.+?)\]\(.+?\)', r'\1', text)
+                }}, 300);
+            }}
+
+            scrollToTarget();
+            window.addEventListener('load', scrollToTarget);
+        </script>
+        """,
+        height=0,
+    )
 
-    # Remove headers
-    text = re.sub(r'^#+\s+', '', text, flags=re.MULTILINE)
+# Latency tracer shared by every session, optionally exposing /metrics and /spans over HTTP
+@st.cache_resource
+def get_tracer():
+    tracer = Tracer(log_path=os.getenv("TRACE_LOG_PATH"))
+    if os.getenv("METRICS_PORT"):
+        start_metrics_server(tracer, int(os.getenv("METRICS_PORT")), os.getenv("METRICS_HOST", "127.0.0.1"))
+    return tracer
+
+# Function to identify this session in traces
+def trace_session_id():
+    """Return a hash of the session id; the id itself opens the conversation, so spans never carry it"""
+    return hashlib.sha256(st.session_state.session_id.encode("utf-8")).hexdigest()[:16]
+
+# Function to start tracing a conversation turn
+def start_turn(mode):
+    """Return a Turn tagged with this session, its language and personality"""
+    return get_tracer().turn(
+        session_id=trace_session_id(),
+        language=st.session_state.language,
+        personality=st.session_state.personality,
+        mode=mode
+    )
 
-    # Remove bullet points and list markers
-    text = re.sub(r'^\s*[-*+]\s+', '', text, flags=re.MULTILINE)
-    text = re.sub(r'^\s*\d+\.\s+', '', text, flags=re.MULTILINE)
+# Shared pool for synthesizing reply sentences in the background
+@st.cache_resource
+def get_tts_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="tts")
+
+# Synthesized speech cache shared by every session (and every process using the same directory)
+@st.cache_resource
+def get_tts_cache():
+    return TTSCache(
+        os.getenv("TTS_CACHE_DIR", os.path.join(".cache", "tts")),
+        max_bytes=int(os.getenv("TTS_CACHE_MAX_MB", "200")) * 1024 * 1024
+    )
 
-    # Remove extra symbols that don't add to speech
-    text = re.sub(r'[#|>]', '', text)
+# Audio served by URL from the static folder (server.enableStaticServing in .streamlit/config.toml)
+@st.cache_resource
+def get_media_store():
+    return MediaStore(
+        os.getenv("MEDIA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "media")),
+        "/app/static/media",
+        max_bytes=int(os.getenv("MEDIA_STORE_MAX_MB", "200")) * 1024 * 1024
+    )
 
-    # Clean up multiple spaces and newlines
-    text = re.sub(r'\n+', '. ', text)
-    text = re.sub(r'\s+', ' ', text)
+# Stable URL for a piece of audio, so reruns reference it instead of uploading it again
+def media_url(audio_data, default_format="mp3"):
+    return get_media_store().add(audio_data, sniff_format(audio_data) or default_format)
+
+# Speech-to-text engine, loaded once per process and shared by every session
+@st.cache_resource
+def get_stt_engine():
+    return create_stt_engine(os.getenv("STT_ENGINE", "google"))
+
+# Shared pool for transcribing recording segments while the user is still speaking
+@st.cache_resource
+def get_stt_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="stt")
+
+# Separate pool for the chunks of long texts; the TTS pool's workers wait on them
+@st.cache_resource
+def get_tts_chunk_executor():
+    return ThreadPoolExecutor(max_workers=int(os.getenv("TTS_CHUNK_WORKERS", "8")), thread_name_prefix="tts-chunk")
+
+# Text-to-speech engine, created once per process so the local one stays warm
+@st.cache_resource
+def get_tts_engine():
+    return create_tts_engine(os.getenv("TTS_ENGINE", "auto"))
+
+# Speech synthesizer: the engine, with long texts split into chunks that are
+# synthesized in parallel
+@st.cache_resource
+def get_synthesizer():
+    return ChunkedSynthesizer(get_tracer().wrap("tts_synthesize", get_tts_engine()), get_tts_chunk_executor())
+
+# Background synthesis for message audio players, so rendering never waits on TTS
+@st.cache_resource
+def get_tts_jobs():
+    return TTSJobQueue(
+        get_tts_cache(),
+        get_tts_executor(),
+        synthesize=get_synthesizer(),
+        voice=get_tts_engine().name
+    )
 
-    # Remove leading/trailing whitespace
-    text = text.strip()
+# Function to turn a message into the text that gets spoken
+def prepare_speech_text(text):
+    """Convert a message's markdown for TTS"""
+    return normalize_for_speech(text)
+
+# Function to look up TTS audio without blocking the page
+def get_tts_audio(text, tts_lang_code, request=False):
+    """Return (audio URL, status) for a message, queueing synthesis in the background if requested"""
+    tts_text = prepare_speech_text(text)
+
+    # Content-addressed key, so the same text in the same language is only synthesized once
+    jobs = get_tts_jobs()
+    audio_key = jobs.key(tts_text, tts_lang_code)
+    if audio_key in st.session_state.tts_audio:
+        audio_url = st.session_state.tts_audio[audio_key]
+        if get_media_store().contains(audio_url):
+            return audio_url, "ready"
+        # The file was evicted from the static folder, add it again from the TTS cache
+        del st.session_state.tts_audio[audio_key]
+
+    status = jobs.status(audio_key)
+    if status is None and request:
+        status = jobs.submit(tts_text, tts_lang_code)
+
+    if status == "ready":
+        audio_data = get_tts_cache().get(audio_key)
+        if audio_data is None:
+            # Evicted between the check and the read, synthesize it again
+            return None, jobs.submit(tts_text, tts_lang_code)
+        # Remember the URL in session state to skip the cache and the hashing on reruns
+        audio_url = media_url(audio_data)
+        st.session_state.tts_audio[audio_key] = audio_url
+        return audio_url, "ready"
+
+    return None, status
+
+# Button callback: queue audio for a message (callbacks run before the fragment redraws)
+def request_message_audio(idx, text, tts_lang_code, autoplay=False):
+    get_tts_audio(text, tts_lang_code, request=True)
+    if autoplay:
+        st.session_state.autoplay_message_index = idx
+
+# Placeholder that waits for a background TTS job
+@st.fragment(run_every=1.0)
+def pending_audio_placeholder(text, tts_lang_code):
+    """Poll a queued TTS job and rerun the page once its audio is ready"""
+    jobs = get_tts_jobs()
+    if jobs.status(jobs.key(prepare_speech_text(text), tts_lang_code)) == "pending":
+        st.caption("🎵 Generating audio...")
+    else:
+        st.rerun()
 
-    return text
+# Model per system prompt (personality + language), shared by every session
+@st.cache_resource
+def get_model(system_prompt):
+    return create_model(system_prompt, os.getenv("LLM_BACKEND", "gemini"))
+
+# Scheduler every Gemini request of this process goes through: caps requests in flight,
+# rate-limits them, retries transient errors and merges identical overlapping ones
+@st.cache_resource
+def get_llm_scheduler():
+    scheduler = RequestScheduler(
+        max_in_flight=int(os.getenv("LLM_MAX_IN_FLIGHT", "4")),
+        rate=float(os.getenv("LLM_RATE_LIMIT", "0")) or None,
+        burst=int(os.getenv("LLM_BURST", "0")) or None,
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "3"))
+    )
+    get_tracer().add_gauge("llm_queue_depth", "Gemini requests waiting for a free slot",
+                           lambda: scheduler.stats()["queued"])
+    get_tracer().add_gauge("llm_in_flight", "Gemini requests being sent or streamed",
+                           lambda: scheduler.stats()["in_flight"])
+    return scheduler
+
+# Replies to repeated opening questions, shared by every session of the process
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(
+        max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "1000")),
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+        max_history=int(os.getenv("RESPONSE_CACHE_MAX_HISTORY", "4"))
+    )
 
-# Function to generate TTS audio
-def generate_tts_audio(text, message_index, tts_lang_code):
-    """Generate audio from text using gTTS and store in session state"""
-    try:
-        # Create a unique key for this message including language
-        audio_key = f"audio_{message_index}_{tts_lang_code}"
+# Pool for refreshing conversation summaries off the turn's critical path
+@st.cache_resource
+def get_summary_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+# Function to get this session's context window
+def get_context_window():
+    """Return the window that keeps recent turns verbatim and summarizes older ones"""
+    if st.session_state.context_window is None:
+        st.session_state.context_window = ContextWindow(
+            int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000")),
+            partial(get_llm_scheduler().call, summarize_conversation, get_model(SUMMARY_SYSTEM_PROMPT)),
+            get_summary_executor(),
+            max_messages=int(os.getenv("CONTEXT_MAX_MESSAGES", "200"))
+        )
+    return st.session_state.context_window
+
+# Function to build the system prompt for the current personality and language
+def build_system_prompt():
+    """Return the personality's system prompt with the language instruction added"""
+    return build_personality_prompt(
+        PERSONALITIES[st.session_state.personality]["system_prompt"],
+        LANGUAGES[st.session_state.language]["name"]
+    )
 
-        # Only generate if not already generated
-        if audio_key not in st.session_state.tts_audio:
-            # Clean text for better speech
-            clean_text = clean_text_for_speech(text)
+# Function to get this session's chat
+def get_chat():
+    """Return the session's chat and the history it holds, only rebuilding it when the prompt or history changed"""
+    system_prompt = build_system_prompt()
+
+    # Older turns beyond the token budget are replaced by a running summary, so only
+    # the messages after it are read from the session store
+    context_window = get_context_window()
+    summary, recent = context_window.build(st.session_state.messages)
+
+    if (st.session_state.chat is None
+            or st.session_state.chat_system_prompt != system_prompt
+            or st.session_state.chat_synced != chat_fingerprint(st.session_state.messages)
+            or st.session_state.chat_summarized != context_window.summarized_count):
+        st.session_state.chat = get_model(system_prompt).start_chat(history=chat_history(summary, recent))
+        st.session_state.chat_system_prompt = system_prompt
+        st.session_state.chat_synced = chat_fingerprint(st.session_state.messages)
+        st.session_state.chat_summarized = context_window.summarized_count
+
+    # Request and cache keys cover what the model sees: the summary and the messages after it
+    history = [{"role": "user", "content": summary}] + recent if summary else recent
+    return st.session_state.chat, history
+
+# Turns run on the engine's event loop, shared by every session, so a script run only
+# submits them and a fragment polls for the result
+@st.cache_resource
+def get_conversation_engine():
+    engine = ConversationEngine(
+        get_llm_scheduler(),
+        stt_engine=get_stt_engine(),
+        response_cache=get_response_cache(),
+        tts_cache=get_tts_cache(),
+        synthesize=get_synthesizer(),
+        tts_executor=get_tts_executor(),
+        voice=get_tts_engine().name,
+        tracer=get_tracer(),
+        max_workers=int(os.getenv("CONVERSATION_WORKERS", "32"))
+    )
+    get_tracer().add_gauge("conversation_turns_active", "Conversation turns being transcribed, generated or spoken",
+                           lambda: engine.stats()["active"])
+    return engine
+
+# Audio queue living in the parent page, so it keeps playing while the iframe that
+# feeds it is redrawn; update() adds the clips of a reply it hasn't seen yet
+SPEECH_QUEUE_SCRIPT = """
+window.voiceReplyQueue = (function () {
+    const state = { id: null, urls: [], next: 0, audio: null, stopped: false };
+    function stop() {
+        if (state.audio) {
+            state.audio.pause();
+            state.audio = null;
+        }
+    }
+    function playNext() {
+        if (state.stopped || state.audio || state.next >= state.urls.length) {
+            return;
+        }
+        const audio = new Audio(state.urls[state.next++]);
+        const done = () => {
+            if (state.audio === audio) {
+                state.audio = null;
+                playNext();
+            }
+        };
+        state.audio = audio;
+        audio.onended = done;
+        audio.onerror = done;
+        audio.play().catch(done);
+    }
+    return {
+        update(id, urls, stopped) {
+            if (id !== state.id) {
+                stop();
+                Object.assign(state, { id: id, urls: [], next: 0, stopped: false });
+            }
+            if (stopped) {
+                state.stopped = true;
+                stop();
+                return;
+            }
+            for (let i = state.urls.length; i < urls.length; i++) {
+                state.urls.push(String(urls[i]));
+            }
+            playNext();
+        }
+    };
+})();
+"""
+
+# Function to collect the URLs of a reply's sentences synthesized so far
+def reply_speech_queue(turn):
+    """Return the session's audio queue for the turn, with any newly synthesized sentences added"""
+    queue = st.session_state.speech_queue
+    if queue is None or queue["turn"] != turn.id:
+        queue = {"id": uuid.uuid4().hex, "turn": turn.id, "urls": [], "stopped": False, "flush": False}
+        st.session_state.speech_queue = queue
+    for audio in turn.speech_segments()[len(queue["urls"]):]:
+        queue["urls"].append(media_url(audio))
+    return queue
+
+# Function to play queued sentences in the browser, one after the other
+def speech_queue_player(queue):
+    components.html(
+        f"""
+        <script>
+            const page = window.parent;
+            if (!page.voiceReplyQueue) {{
+                const script = page.document.createElement('script');
+                script.textContent = {json.dumps(SPEECH_QUEUE_SCRIPT)};
+                page.document.head.appendChild(script);
+            }}
+            page.voiceReplyQueue.update({json.dumps(queue["id"])}, {json.dumps(queue["urls"])}, {json.dumps(queue["stopped"])});
+        </script>
+        """,
+        height=0,
+    )
 
-            # Warn for very long messages
-            if len(clean_text) > 500:
-                with st.spinner("🎵 Generating audio for long message..."):
-                    # Truncate extremely long messages for TTS
-                    tts_text = clean_text[:1000] + "..." if len(clean_text) > 1000 else clean_text
+# Function to start a conversation turn
+def submit_turn(mode, prompt=None, audio=None, transcriber=None, recording_url=None):
+    """Hand a typed prompt or a recording to the conversation engine, replacing any turn still running"""
+    if st.session_state.pending_turn is not None:
+        finish_turn(st.session_state.pending_turn, stopped=True)
+
+    lang_config = LANGUAGES[st.session_state.language]
+    chat, history = get_chat()
+    st.session_state.pending_turn = get_conversation_engine().submit(
+        chat,
+        build_system_prompt(),
+        history,
+        prompt=prompt,
+        audio=audio,
+        transcriber=transcriber,
+        speech_lang_code=lang_config['speech_recognition_code'],
+        tts_lang_code=lang_config['tts_code'],
+        voice=st.session_state.enable_voice_response,
+        stream=st.session_state.stream_responses,
+        # Recordings are sent after a second, so the transcript can be read first
+        send_delay=1.0 if prompt is None else 0.0,
+        trace=start_turn(mode)
+    )
+    st.session_state.pending_turn_mode = mode
+    # Played back next to the transcript while the turn runs
+    st.session_state.pending_recording_url = recording_url
+
+# Function to add a finished (or stopped) turn to the conversation
+def finish_turn(turn, stopped=False):
+    """Append the turn's messages and update the voice modes' bookkeeping"""
+    st.session_state.pending_turn = None
+    st.session_state.pending_recording_url = None
+    voice_turn = st.session_state.pending_turn_mode != "text"
+    if stopped:
+        turn.cancel()
+        queue = st.session_state.speech_queue
+        if queue is not None and queue["turn"] == turn.id:
+            # Silence the sentences already playing, on the next full run
+            queue["stopped"] = True
+            queue["flush"] = True
+
+    if turn.prompt is None:
+        # Stopped before the recording was transcribed, nothing to keep
+        return
+    st.session_state.messages.append({"role": "user", "content": turn.prompt})
+
+    if stopped or turn.status != "done":
+        if stopped or turn.status == "cancelled":
+            error_message = f"{turn.text}\n\n*(stopped)*" if turn.text else "*(stopped)*"
+        else:
+            error_message = f"Error: {str(turn.error)}"
+        # Marked so the failed turn is left out of the model's history
+        st.session_state.messages.append({
+            "role": "assistant",
+            "content": error_message,
+            "error": True
+        })
+        st.session_state.chat = None
+        return
+
+    st.session_state.messages.append({
+        "role": "assistant",
+        "content": turn.text
+    })
+    st.session_state.chat_synced = chat_fingerprint(st.session_state.messages)
+
+    if turn.audio is not None:
+        # The reply's audio was synthesized along with it, store it under the message's key
+        st.session_state.tts_audio[turn.audio_key] = media_url(turn.audio)
+    if voice_turn and st.session_state.enable_voice_response:
+        queue = reply_speech_queue(turn)
+        if queue["urls"]:
+            # Replies to voice input are spoken sentence by sentence as they are synthesized;
+            # the sentences finished since the last poll are queued on the next full run
+            queue["flush"] = True
+        else:
+            # Start speaking right away once the whole reply's audio is ready
+            st.session_state.autoplay_message_index = len(st.session_state.messages) - 1
+
+    if voice_turn:
+        # Store the transcription for editing after response
+        st.session_state.voice_text = turn.prompt
+        # Show edit section after response is received
+        st.session_state.show_edit = True
+
+        # If conversation flow mode is enabled, show continue prompt
+        if st.session_state.conversation_flow_mode:
+            st.session_state.show_continue_prompt = True
+            st.session_state.conversation_turns += 1
+
+        # If automatic mode is enabled, increment trigger to restart recorder
+        if st.session_state.automatic_mode:
+            st.session_state.auto_record_trigger += 1
+            st.session_state.conversation_turns += 1
+
+# Button callback: stop the running turn
+def stop_pending_turn():
+    if st.session_state.pending_turn is not None:
+        finish_turn(st.session_state.pending_turn, stopped=True)
+
+# The turn being worked on, polled until the engine is done with it; only called while
+# a turn is pending, so idle sessions don't poll
+@st.fragment(run_every=0.25)
+def render_pending_turn():
+    turn = st.session_state.pending_turn
+    if turn is None:
+        # Stopped from the button, redraw the page with the stopped turn in the transcript
+        st.rerun()
+    if turn.done:
+        finish_turn(turn)
+        st.rerun()
 
-                    # Generate speech with selected language
-                    tts = gTTS(text=tts_text, lang=tts_lang_code, slow=False)
+    lang_config = LANGUAGES[st.session_state.language]
+    with st.chat_message("user"):
+        if st.session_state.pending_recording_url:
+            st.audio(st.session_state.pending_recording_url)
+        if turn.prompt is None:
+            st.markdown(f"*Transcribing your voice ({lang_config['flag']} {lang_config['name']})...*")
+        else:
+            st.markdown(turn.prompt)
+    if turn.status == "waiting":
+        st.info("Sending in 1 second...")
 
-                    # Save to bytes
-                    audio_bytes = io.BytesIO()
-                    tts.write_to_fp(audio_bytes)
-                    audio_bytes.seek(0)
+    with st.chat_message("assistant"):
+        if turn.text:
+            # Partial text shows up as chunks arrive so the first words appear right away
+            st.markdown(turn.text + " ▌")
+        elif turn.status == "thinking":
+            st.markdown("*Thinking...*")
+    if st.session_state.pending_turn_mode != "text" and st.session_state.enable_voice_response:
+        # Replies to voice input start speaking at their first synthesized sentence
+        queue = reply_speech_queue(turn)
+        if queue["urls"]:
+            speech_queue_player(queue)
+    st.button("⏹️ Stop", key="stop_pending_turn", on_click=stop_pending_turn)
+
+# Function to get the background transcriber for a streamed utterance
+def get_segment_transcriber(utterance_id):
+    """Return the transcriber for an utterance, creating it on its first segment"""
+    transcribers = st.session_state.segment_transcribers
+    if utterance_id not in transcribers:
+        # Only the current utterance matters, drop older ones
+        transcribers.clear()
+        transcribers[utterance_id] = IncrementalTranscriber(
+            get_stt_engine(),
+            LANGUAGES[st.session_state.language]['speech_recognition_code'],
+            get_stt_executor(),
+            decode_for_recognition
+        )
+    return transcribers[utterance_id]
+
+# Running transcript shown while the user is still speaking
+@st.fragment(run_every=0.5)
+def partial_transcript_view(utterance_id):
+    """Show the text of the segments transcribed so far"""
+    transcriber = st.session_state.segment_transcribers.get(utterance_id)
+    if transcriber is not None:
+        st.caption(f"📝 {transcriber.partial_transcript() or 'Listening...'}")
+
+# Sidebar, a fragment so toggling a setting doesn't redraw the conversation
+@st.fragment
+def render_sidebar():
+    # Settings that change what the main page shows need a full rerun
+    page_settings = (
+        st.session_state.enable_voice_response,
+        st.session_state.conversation_flow_mode,
+        st.session_state.automatic_mode,
+    )
 
-                    # Store in session state
-                    st.session_state.tts_audio[audio_key] = audio_bytes.read()
-            else:
-                # Generate speech for normal messages with selected language
-                tts = gTTS(text=clean_text, lang=tts_lang_code, slow=False)
-
-                # Save to bytes
-                audio_bytes = io.BytesIO()
-                tts.write_to_fp(audio_bytes)
-                audio_bytes.seek(0)
-
-                # Store in session state
-                st.session_state.tts_audio[audio_key] = audio_bytes.read()
-
-        return st.session_state.tts_audio[audio_key]
-    except Exception as e:
-        st.error(f"❌ Audio generation failed: {str(e)}")
-        return None
-
-# Function to transcribe audio to text
-def transcribe_audio(audio_bytes, language_code):
-    """Convert audio bytes to text using speech recognition"""
-    try:
-        # Initialize recognizer with optimized settings
-        recognizer = sr.Recognizer()
-
-        # Adjust energy threshold for better recognition
-        recognizer.energy_threshold = 200  # Lower threshold for quieter speech
-        recognizer.dynamic_energy_threshold = True
-        recognizer.pause_threshold = 0.8  # Shorter pause detection
-
-        # Save audio bytes to a temporary WAV file for better compatibility
-        import tempfile
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_audio:
-            temp_audio.write(audio_bytes)
-            temp_audio_path = temp_audio.name
-
-        # Load audio file using speech_recognition
-        with sr.AudioFile(temp_audio_path) as source:
-            # Adjust for ambient noise with longer duration for better accuracy
-            recognizer.adjust_for_ambient_noise(source, duration=0.3)
-
-            # Record the audio
-            audio_data = recognizer.record(source)
-
-        # Clean up temporary file
-        import os
-        os.unlink(temp_audio_path)
-
-        # Try to recognize speech with show_all=True to get alternatives
-        try:
-            # Get detailed results with confidence scores using the selected language
-            result = recognizer.recognize_google(audio_data, language=language_code, show_all=True)
-
-            if result and len(result['alternative']) > 0:
-                # Return the best transcription (first alternative has highest confidence)
-                text = result['alternative'][0]['transcript']
-                return text
-            else:
-                return "[unclear audio - could not transcribe]"
-
-        except:
-            # Fallback to simple recognition with selected language
-            text = recognizer.recognize_google(audio_data, language=language_code)
-            return text
-
-    except sr.UnknownValueError:
-        # Return a placeholder that allows editing instead of an error
-        return "[unclear audio - please edit]"
-    except sr.RequestError as e:
-        return f"[Error: {e}]"
-    except Exception as e:
-        return f"[Error: {str(e)}]"
-
-# Sidebar
-with st.sidebar:
     st.title("🤖 AI Chatbot Settings")
     st.markdown("---")
 
@@ -350,13 +750,11 @@ with st.sidebar:
     if selected_language != st.session_state.language:
         st.session_state.last_language = st.session_state.language
         st.session_state.language = selected_language
-        # Clear TTS audio cache when language changes
-        st.session_state.tts_audio = {}
+        # Audio is cached per language, so switching back reuses what was already generated
         st.rerun()
 
     # Also update last_language if they match (for tracking)
     if st.session_state.language != st.session_state.last_language:
-        st.session_state.tts_audio = {}
         st.session_state.last_language = st.session_state.language
 
     # Display current language info
@@ -376,7 +774,8 @@ with st.sidebar:
     # Update personality if changed
     if selected_personality != st.session_state.personality:
         st.session_state.personality = selected_personality
-        st.session_state.messages = []  # Clear chat history on personality change
+        st.session_state.messages.clear()  # Clear chat history on personality change
+        st.session_state.transcript_window = TRANSCRIPT_PAGE_SIZE
         st.rerun()
 
     # Display personality info
@@ -390,9 +789,53 @@ with st.sidebar:
     st.subheader("About")
     st.write("This chatbot uses Google's Gemini 2.5 Flash model to provide intelligent responses.")
 
+    if st.session_state.context_window is not None and st.session_state.context_window.summarized_count:
+        st.caption(f"🧠 {st.session_state.context_window.summarized_count} earlier messages are summarized to keep requests small")
+
+    st.session_state.stream_responses = st.checkbox(
+        "⚡ Stream responses",
+        value=st.session_state.stream_responses,
+        help="Show the reply word by word as it is generated instead of waiting for the full answer"
+    )
+
+    # Latency per stage across all sessions on this server
+    with st.expander("⏱️ Latency", expanded=False):
+        stage_summary = get_tracer().stage_summary()
+        if stage_summary:
+            st.table([
+                {
+                    "Stage": stage,
+                    "Count": stats["count"],
+                    "p50 (ms)": round(stats["p50"] * 1000),
+                    "p95 (ms)": round(stats["p95"] * 1000),
+                }
+                for stage, stats in stage_summary.items()
+            ])
+        else:
+            st.caption("No turns traced yet.")
+        response_stats = get_response_cache().stats()
+        st.caption(
+            f"💾 Response cache: {response_stats['hits']} hits / {response_stats['misses']} misses "
+            f"({response_stats['hit_rate']:.0%}, {response_stats['entries']} replies)"
+        )
+        engine_stats = get_conversation_engine().stats()
+        st.caption(
+            f"🧵 Conversation engine: {engine_stats['active']} turns running, {engine_stats['done']} done, "
+            f"{engine_stats['cancelled']} stopped, {engine_stats['failed']} failed"
+        )
+        llm_stats = get_llm_scheduler().stats()
+        st.caption(
+            f"🤖 Gemini requests: {llm_stats['in_flight']}/{llm_stats['max_in_flight']} in flight, "
+            f"{llm_stats['queued']} queued, {llm_stats['retries']} retried, {llm_stats['coalesced']} merged, "
+            f"{llm_stats['abandoned']} stopped"
+        )
+        if os.getenv("METRICS_PORT"):
+            st.caption(f"Prometheus metrics on port {os.getenv('METRICS_PORT')} at /metrics, raw spans at /spans")
+
     # Clear chat button
     if st.button("Clear Chat History"):
-        st.session_state.messages = []
+        st.session_state.messages.clear()
+        st.session_state.transcript_window = TRANSCRIPT_PAGE_SIZE
         st.rerun()
 
     st.markdown("---")
@@ -405,6 +848,25 @@ with st.sidebar:
         if st.session_state.enable_voice_response:
             st.info("💡 Tip: Audio players will appear below AI responses. Click play to listen!")
 
+            cache_stats = get_tts_cache().stats()
+            st.caption(
+                f"🗄️ Audio cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+                f"({cache_stats['entries']} clips, {cache_stats['bytes'] / (1024 * 1024):.1f} MB)"
+            )
+            media_stats = get_media_store().stats()
+            st.caption(
+                f"📁 Playback files: {media_stats['files']} files, {media_stats['bytes'] / (1024 * 1024):.1f} MB"
+            )
+
+            # With several engines, show which ones answer and how fast
+            engine = get_tts_engine()
+            if hasattr(engine, "stats"):
+                engine_notes = []
+                for name, engine_stats in engine.stats().items():
+                    note = name if engine_stats["latency"] is None else f"{name} {engine_stats['latency'] * 1000:.0f} ms"
+                    engine_notes.append(note if engine_stats["available"] else f"{note} (failing)")
+                st.caption(f"🗣️ Speech engines: {', '.join(engine_notes)}")
+
         st.markdown("---")
 
         st.session_state.conversation_flow_mode = st.checkbox(
@@ -439,7 +901,7 @@ with st.sidebar:
                         st.rerun()
         elif st.session_state.automatic_mode:
             st.success("✅ Automatic mode active - hands-free conversation enabled!")
-            st.info("🎙️ The microphone will automatically start after AI responds and stop when you finish speaking (2 seconds of silence).")
+            st.info("🎙️ The microphone will automatically start after AI responds and stop when you finish speaking (after a short pause).")
             if st.session_state.conversation_turns > 0:
                 col1, col2 = st.columns([3, 1])
                 with col1:
@@ -450,339 +912,286 @@ with st.sidebar:
                         st.session_state.auto_record_trigger = 0
                         st.rerun()
 
+    if page_settings != (
+        st.session_state.enable_voice_response,
+        st.session_state.conversation_flow_mode,
+        st.session_state.automatic_mode,
+    ):
+        st.rerun()
+
+with st.sidebar:
+    render_sidebar()
+
 # Main chat interface
 st.title(f"💬 Chat with {PERSONALITIES[st.session_state.personality]['name']}")
 
-# Display chat messages
-for idx, message in enumerate(st.session_state.messages):
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+# Button callback: reveal another page of older messages
+def show_earlier_messages():
+    st.session_state.transcript_window += TRANSCRIPT_PAGE_SIZE
+
+# Display chat messages, a fragment so loading audio for one reply doesn't rerun the page
+@st.fragment
+def render_transcript():
+    # Only the latest messages are rendered, so long sessions don't grow the page
+    messages = st.session_state.messages
+    first_shown = max(0, len(messages) - st.session_state.transcript_window)
+    if first_shown > 0:
+        st.button(
+            f"⬆️ Show earlier messages ({first_shown} hidden)",
+            key="show_earlier_messages",
+            on_click=show_earlier_messages,
+        )
 
-    # Display audio player OUTSIDE chat message for assistant responses
-    if message["role"] == "assistant" and st.session_state.enable_voice_response:
-        # Add subtle divider for visual separation
-        st.markdown("---")
+    for idx in range(first_shown, len(messages)):
+        message = messages[idx]
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
 
-        # Use columns for better layout (responsive on mobile)
-        col1, col2 = st.columns([4, 1])
+        # Display audio player OUTSIDE chat message for assistant responses (not for errors)
+        if message["role"] == "assistant" and st.session_state.enable_voice_response and not message.get("error"):
+            # Add subtle divider for visual separation
+            st.markdown("---")
 
-        with col1:
-            # Get TTS language code for the selected language
-            tts_lang_code = LANGUAGES[st.session_state.language]['tts_code']
+            # Use columns for better layout (responsive on mobile)
+            col1, col2 = st.columns([4, 1])
 
-            audio_data = generate_tts_audio(message["content"], idx, tts_lang_code)
-            if audio_data:
-                lang_info = LANGUAGES[st.session_state.language]
-                st.markdown(f"🔊 **Listen to response** ({lang_info['flag']} {lang_info['name']}):")
-                st.audio(audio_data, format="audio/mp3")
+            with col1:
+                # Get TTS language code for the selected language
+                tts_lang_code = LANGUAGES[st.session_state.language]['tts_code']
+
+                # Only the latest reply is synthesized automatically, older ones on request
+                is_latest = idx == len(st.session_state.messages) - 1
+                audio_url, status = get_tts_audio(message["content"], tts_lang_code, request=is_latest)
+                if audio_url:
+                    lang_info = LANGUAGES[st.session_state.language]
+                    st.markdown(f"🔊 **Listen to response** ({lang_info['flag']} {lang_info['name']}):")
+
+                    # Start speaking right away for replies to voice input
+                    autoplay = st.session_state.autoplay_message_index == idx
+                    st.audio(audio_url, autoplay=autoplay)
+                    if autoplay:
+                        st.session_state.autoplay_message_index = None
+                elif status == "pending":
+                    pending_audio_placeholder(message["content"], tts_lang_code)
+                elif status == "busy":
+                    st.caption("⏳ Audio queue is busy, try again in a moment.")
+                elif status == "failed":
+                    jobs = get_tts_jobs()
+                    audio_key = jobs.key(prepare_speech_text(message["content"]), tts_lang_code)
+                    st.error(f"❌ Audio generation failed: {jobs.error(audio_key)}")
+                    st.button(
+                        "Retry audio",
+                        key=f"retry_audio_{idx}",
+                        on_click=request_message_audio,
+                        args=(idx, message["content"], tts_lang_code),
+                    )
+                else:
+                    # Start playing as soon as it is ready, since the user asked for it
+                    st.button(
+                        "🔊 Play response",
+                        key=f"load_audio_{idx}",
+                        on_click=request_message_audio,
+                        args=(idx, message["content"], tts_lang_code),
+                        kwargs={"autoplay": True},
+                    )
 
-                # Show truncation warning if message was too long
-                if len(message["content"]) > 1000:
-                    st.caption("⚠️ Audio truncated to first 1000 characters")
-            else:
-                st.error("❌ Could not generate audio. Please try refreshing the page.")
+            with col2:
+                # Empty column for spacing (adjusts automatically on mobile)
+                pass
 
-        with col2:
-            # Empty column for spacing (adjusts automatically on mobile)
-            pass
+            st.markdown("")  # Add spacing after audio section
 
-        st.markdown("")  # Add spacing after audio section
+render_transcript()
 
-# Voice Input Section
-st.markdown("### 🎤 Voice Input")
+# The turn in progress, shown below the conversation
+if st.session_state.pending_turn is not None:
+    render_pending_turn()
 
-# Show different prompts based on mode
-if st.session_state.automatic_mode and len(st.session_state.messages) > 0 and st.session_state.messages[-1]["role"] == "assistant":
-    st.info("🤖 **Automatic mode active** - Recording will start automatically below...")
-    st.markdown("---")
-elif st.session_state.show_continue_prompt and st.session_state.conversation_flow_mode:
-    st.success("### 🎙️ **Ready to continue? Click the microphone below!**")
-    st.info(f"💬 Conversation turn #{st.session_state.conversation_turns + 1} - Keep the conversation going!")
-
-    # Add a dismiss button
-    col1, col2 = st.columns([4, 1])
-    with col2:
-        if st.button("✓ Got it", type="secondary"):
-            st.session_state.show_continue_prompt = False
-            st.rerun()
+# The last sentences of a finished reply (or the stop of a stopped one), sent once
+if st.session_state.speech_queue is not None and st.session_state.speech_queue["flush"]:
+    st.session_state.speech_queue["flush"] = False
+    speech_queue_player(st.session_state.speech_queue)
 
-    st.markdown("---")
+# Button callbacks for the voice input section
+def dismiss_continue_prompt():
+    st.session_state.show_continue_prompt = False
 
-with st.expander("ℹ️ How to use voice input", expanded=False):
-    st.markdown("""
-    **Manual Mode (Default):**
-    1. Select your preferred language in the sidebar (🌍 Language)
-    2. Click the microphone button below
-    3. Speak your message clearly in the selected language
-    4. Click stop when finished
-    5. Message will auto-send after 1 second
-
-    **🔄 Enhanced Conversation Flow (Semi-Automatic):**
-    - Enable in Voice Settings sidebar
-    - After AI responds, you'll see a prominent "Continue" prompt
-    - Page automatically scrolls to microphone
-    - Track conversation turns in the sidebar
-    - Makes multi-turn conversations much faster!
-
-    **🤖 Fully Automatic Mode (Hands-Free):**
-    - Enable "Fully Automatic Mode" in Voice Settings
-    - Microphone automatically starts after AI responds
-    - Uses Voice Activity Detection (VAD) to detect when you stop speaking
-    - Automatically stops after 2 seconds of silence
-    - Perfect for hands-free, natural conversations!
-    - Note: Only one mode can be active at a time
-
-    **Tips:**
-    - Speak clearly and at a normal pace
-    - Minimize background noise for best results
-    - You can edit transcriptions if needed
-    - AI will respond in your selected language
-
-    **Supported Languages:**
-    🇺🇸 English | 🇪🇸 Spanish | 🇫🇷 French | 🇨🇳 Chinese | 🇯🇵 Japanese
-    """)
-
-# Show edit option BEFORE the audio recorder
-if st.session_state.show_edit and st.session_state.voice_text and len(st.session_state.messages) > 0:
-    if st.session_state.messages[-2]["content"] == st.session_state.voice_text if len(st.session_state.messages) >= 2 else False:
-        with st.expander("📝 Edit Last Voice Message", expanded=True):
-            edited_text = st.text_area(
-                "Edit and resend:",
-                value=st.session_state.voice_text,
-                height=80,
-                key="voice_edit_area"
-            )
+def clear_voice_edit():
+    st.session_state.voice_text = ""
+    st.session_state.show_edit = False
 
-            col1, col2 = st.columns([1, 5])
-            with col1:
-                if st.button("Resend", type="primary", key="resend_voice"):
-                    st.session_state.messages = st.session_state.messages[:-2]
-                    st.session_state.messages.append({"role": "user", "content": edited_text})
-                    st.session_state.voice_text = ""
-                    st.session_state.show_edit = False
-                    st.rerun()
-            with col2:
-                if st.button("Clear", key="clear_edit"):
-                    st.session_state.voice_text = ""
-                    st.session_state.show_edit = False
-                    st.rerun()
-
-# Audio recorder - use different component based on mode
-audio_bytes = None
-
-if st.session_state.automatic_mode:
-    # Use continuous WebRTC recorder with Voice Activity Detection
-    # Auto-start if this is after an AI response
-    should_auto_start = len(st.session_state.messages) > 0 and st.session_state.messages[-1]["role"] == "assistant"
-
-    audio_data = continuous_voice_recorder(
-        auto_start=should_auto_start,
-        silence_threshold=0.02,
-        silence_duration=2.0,
-        key=f"auto_recorder_{st.session_state.auto_record_trigger}"
-    )
+# Voice Input Section, a fragment so recording reruns only this part until a reply is added
+@st.fragment
+def render_voice_input():
+    st.markdown("### 🎤 Voice Input")
 
-    # Convert base64 data URL to bytes if audio was received
-    if audio_data and 'audio' in audio_data:
-        import base64
-        import re
-        # Extract base64 data from data URL
-        match = re.match(r'data:audio/(\w+);base64,(.+)', audio_data['audio'])
-        if match:
-            audio_base64 = match.group(2)
-            audio_bytes = base64.b64decode(audio_base64)
-
-else:
-    # Use manual audio recorder
-    audio_bytes = audio_recorder(
-        text="Click to record",
-        recording_color="#e74c3c",
-        neutral_color="#3498db",
-        icon_name="microphone",
-        icon_size="2x",
-    )
+    # Show different prompts based on mode
+    if st.session_state.automatic_mode and len(st.session_state.messages) > 0 and st.session_state.messages[-1]["role"] == "assistant":
+        st.info("🤖 **Automatic mode active** - Recording will start automatically below...")
+        st.markdown("---")
+    elif st.session_state.show_continue_prompt and st.session_state.conversation_flow_mode:
+        st.success("### 🎙️ **Ready to continue? Click the microphone below!**")
+        st.info(f"💬 Conversation turn #{st.session_state.conversation_turns + 1} - Keep the conversation going!")
 
-# Process recorded audio and auto-send
-if audio_bytes:
-    # Create a hash of the audio to detect new recordings
-    import hashlib
-    audio_hash = hashlib.md5(audio_bytes).hexdigest()
-
-    # Only process if this is a new recording
-    if audio_hash != st.session_state.last_audio_hash:
-        # Hide edit section when microphone is touched
-        st.session_state.show_edit = False
-        # Clear previous edit text when starting new recording
-        st.session_state.voice_text = ""
-        # Hide continue prompt when user starts speaking
-        st.session_state.show_continue_prompt = False
-
-        st.session_state.last_audio_hash = audio_hash
-
-        st.audio(audio_bytes, format="audio/wav")
-
-        # Get the speech recognition code for the selected language
-        lang_config = LANGUAGES[st.session_state.language]
-        speech_lang_code = lang_config['speech_recognition_code']
-
-        with st.spinner(f"Transcribing your voice ({lang_config['flag']} {lang_config['name']})..."):
-            transcribed_text = transcribe_audio(audio_bytes, speech_lang_code)
-
-        st.success(f"Transcribed: {transcribed_text}")
-
-        # Auto-send after 1 second
-        import time
-        countdown_placeholder = st.empty()
-        countdown_placeholder.info("Sending in 1 second...")
-        time.sleep(1)
-        countdown_placeholder.empty()
-
-        # Auto-send the message
-        prompt = transcribed_text
-
-        # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": prompt})
-
-        # Display user message
-        with st.chat_message("user"):
-            st.markdown(prompt)
-
-        # Generate AI response
-        with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                try:
-                    # Get current personality system prompt
-                    base_system_prompt = PERSONALITIES[st.session_state.personality]["system_prompt"]
-
-                    # Add language instruction to system prompt
-                    lang_name = LANGUAGES[st.session_state.language]["name"]
-                    if st.session_state.language != "English":
-                        system_prompt = f"{base_system_prompt}\n\nIMPORTANT: Please respond in {lang_name}. The user is communicating in {lang_name}, so respond naturally in {lang_name}."
-                    else:
-                        system_prompt = base_system_prompt
-
-                    # Initialize model with system instruction
-                    model = genai.GenerativeModel(
-                        'gemini-2.5-flash',
-                        system_instruction=system_prompt
-                    )
+        # Add a dismiss button
+        col1, col2 = st.columns([4, 1])
+        with col2:
+            st.button("✓ Got it", type="secondary", on_click=dismiss_continue_prompt)
 
-                    # Build conversation history for context
-                    chat_history = []
-                    for msg in st.session_state.messages[:-1]:
-                        # Convert 'assistant' role to 'model' for Gemini API
-                        role = "model" if msg["role"] == "assistant" else msg["role"]
-                        chat_history.append({
-                            "role": role,
-                            "parts": [msg["content"]]
-                        })
-
-                    # Start chat with history
-                    chat = model.start_chat(history=chat_history)
-
-                    # Send message and get response
-                    response = chat.send_message(prompt)
-                    assistant_response = response.text
-
-                    # Display response
-                    st.markdown(assistant_response)
-
-                    # Add assistant response to chat history
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": assistant_response
-                    })
-
-                    # Store the transcription for editing after response
-                    st.session_state.voice_text = transcribed_text
-                    # Show edit section after response is received
-                    st.session_state.show_edit = True
-
-                    # If conversation flow mode is enabled, show continue prompt
-                    if st.session_state.conversation_flow_mode:
-                        st.session_state.show_continue_prompt = True
-                        st.session_state.conversation_turns += 1
-
-                    # If automatic mode is enabled, increment trigger to restart recorder
-                    if st.session_state.automatic_mode:
-                        st.session_state.auto_record_trigger += 1
-                        st.session_state.conversation_turns += 1
-
-                except Exception as e:
-                    error_message = f"Error: {str(e)}"
-                    st.error(error_message)
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": error_message
-                    })
+        st.markdown("---")
 
-        st.rerun()
+    with st.expander("ℹ️ How to use voice input", expanded=False):
+        st.markdown("""
+        **Manual Mode (Default):**
+        1. Select your preferred language in the sidebar (🌍 Language)
+        2. Click the microphone button below
+        3. Speak your message clearly in the selected language
+        4. Click stop when finished
+        5. Message will auto-send after 1 second
+
+        **🔄 Enhanced Conversation Flow (Semi-Automatic):**
+        - Enable in Voice Settings sidebar
+        - After AI responds, you'll see a prominent "Continue" prompt
+        - Page automatically scrolls to microphone
+        - Track conversation turns in the sidebar
+        - Makes multi-turn conversations much faster!
+
+        **🤖 Fully Automatic Mode (Hands-Free):**
+        - Enable "Fully Automatic Mode" in Voice Settings
+        - Microphone automatically starts after AI responds
+        - Uses Voice Activity Detection (VAD) to detect when you stop speaking
+        - Automatically stops after a short pause (under a second) once you finish speaking
+        - Perfect for hands-free, natural conversations!
+        - Note: Only one mode can be active at a time
+
+        **Tips:**
+        - Speak clearly and at a normal pace
+        - Minimize background noise for best results
+        - You can edit transcriptions if needed
+        - AI will respond in your selected language
+
+        **Supported Languages:**
+        🇺🇸 English | 🇪🇸 Spanish | 🇫🇷 French | 🇨🇳 Chinese | 🇯🇵 Japanese
+        """)
+
+    # Show edit option BEFORE the audio recorder
+    if st.session_state.show_edit and st.session_state.voice_text and len(st.session_state.messages) > 0:
+        if st.session_state.messages[-2]["content"] == st.session_state.voice_text if len(st.session_state.messages) >= 2 else False:
+            with st.expander("📝 Edit Last Voice Message", expanded=True):
+                edited_text = st.text_area(
+                    "Edit and resend:",
+                    value=st.session_state.voice_text,
+                    height=80,
+                    key="voice_edit_area"
+                )
 
-st.markdown("---")
+                col1, col2 = st.columns([1, 5])
+                with col1:
+                    if st.button("Resend", type="primary", key="resend_voice"):
+                        st.session_state.messages.truncate(len(st.session_state.messages) - 2)
+                        st.session_state.voice_text = ""
+                        st.session_state.show_edit = False
+                        submit_turn("text", prompt=edited_text)
+                        st.rerun()
+                with col2:
+                    st.button("Clear", key="clear_edit", on_click=clear_voice_edit)
+
+    # Audio recorder - use different component based on mode
+    audio_bytes = None
+    recording = None
+    audio_hash = None
+    segment_transcriber = None
+
+    if st.session_state.automatic_mode:
+        # Use continuous WebRTC recorder with Voice Activity Detection
+        # Auto-start if this is after an AI response
+        should_auto_start = len(st.session_state.messages) > 0 and st.session_state.messages[-1]["role"] == "assistant"
+
+        audio_data = continuous_voice_recorder(
+            auto_start=should_auto_start,
+            silence_threshold=0.01,
+            silence_duration=0.8,
+            stream_segments=True,
+            capture_format="pcm16",
+            key=f"auto_recorder_{st.session_state.auto_record_trigger}"
+        )
 
-# Chat input
-if prompt := st.chat_input("Type your message here or use voice input above..."):
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
+        if audio_data and 'segments' in audio_data:
+            # Segments arrive at pauses and are transcribed in the background while the user keeps talking
+            segment_transcriber = get_segment_transcriber(audio_data['utterance_id'])
+            for segment in audio_data['segments']:
+                if not segment_transcriber.has_segment(segment['index']) and segment['audio']:
+                    segment_transcriber.add_segment(segment['index'], recording_audio(segment))
 
-    # Display user message
-    with st.chat_message("user"):
-        st.markdown(prompt)
+            if audio_data.get('final'):
+                audio_hash = f"utterance_{audio_data['utterance_id']}"
+            else:
+                partial_transcript_view(audio_data['utterance_id'])
+                segment_transcriber = None
+
+        # A whole recording; raw PCM is wrapped with its sample rate, since it has no header to sniff
+        elif audio_data and 'audio' in audio_data:
+            audio_bytes = audio_data['audio']
+            recording = recording_audio(audio_data)
+
+    else:
+        # Use manual audio recorder
+        audio_bytes = audio_recorder(
+            text="Click to record",
+            recording_color="#e74c3c",
+            neutral_color="#3498db",
+            icon_name="microphone",
+            icon_size="2x",
+        )
+        recording = audio_bytes
 
-    # Generate AI response
-    with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            try:
-                # Get current personality system prompt
-                base_system_prompt = PERSONALITIES[st.session_state.personality]["system_prompt"]
-
-                # Add language instruction to system prompt
-                lang_name = LANGUAGES[st.session_state.language]["name"]
-                if st.session_state.language != "English":
-                    system_prompt = f"{base_system_prompt}\n\nIMPORTANT: Please respond in {lang_name}. The user is communicating in {lang_name}, so respond naturally in {lang_name}."
-                else:
-                    system_prompt = base_system_prompt
+    # Create a hash of the audio to detect new recordings
+    if audio_bytes:
+        audio_hash = hashlib.md5(audio_bytes).hexdigest()
+
+    # Process recorded audio and auto-send
+    if audio_hash:
+        # Only process if this is a new recording
+        if audio_hash != st.session_state.last_audio_hash:
+            # Hide edit section when microphone is touched
+            st.session_state.show_edit = False
+            # Clear previous edit text when starting new recording
+            st.session_state.voice_text = ""
+            # Hide continue prompt when user starts speaking
+            st.session_state.show_continue_prompt = False
 
-                # Initialize model with system instruction
-                model = genai.GenerativeModel(
-                    'gemini-2.5-flash',
-                    system_instruction=system_prompt
-                )
+            st.session_state.last_audio_hash = audio_hash
+
+            if st.session_state.automatic_mode:
+                mode = "automatic"
+            elif st.session_state.conversation_flow_mode:
+                mode = "flow"
+            else:
+                mode = "manual"
+
+            # Transcription, the reply and its audio run in the conversation engine
+            submit_turn(
+                mode,
+                audio=recording,
+                transcriber=segment_transcriber,
+                recording_url=media_url(playable_audio(recording), default_format="wav") if recording else None
+            )
+            st.rerun()
+
+render_voice_input()
+
+st.markdown("---")
 
-                # Build conversation history for context
-                chat_history = []
-                for msg in st.session_state.messages[:-1]:  # Exclude the last user message we just added
-                    # Convert 'assistant' role to 'model' for Gemini API
-                    role = "model" if msg["role"] == "assistant" else msg["role"]
-                    chat_history.append({
-                        "role": role,
-                        "parts": [msg["content"]]
-                    })
-
-                # Start chat with history
-                chat = model.start_chat(history=chat_history)
-
-                # Send message and get response
-                response = chat.send_message(prompt)
-                assistant_response = response.text
-
-                # Display response
-                st.markdown(assistant_response)
-
-                # Add assistant response to chat history
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": assistant_response
-                })
-
-            except Exception as e:
-                error_message = f"Error: {str(e)}"
-                st.error(error_message)
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": error_message
-                })
+# Chat input
+if prompt := st.chat_input("Type your message here or use voice input above..."):
+    submit_turn("text", prompt=prompt)
+    st.rerun()
 
 # Footer
 st.markdown("---")
 st.markdown("*Powered by Google Gemini 2.5 Flash | Built with Streamlit*")
+
+save_session_state()
+
+# Time spent rendering this run (runs that end in st.rerun() are covered by the next one)
+get_tracer().record("rerun", time.perf_counter() - run_started, session_id=trace_session_id())
@@ -0,0 +1,120 @@
+"""Load benchmark of the conversation engine, without Streamlit.
+
+Submits text turns from many simulated sessions at once to one
+services.conversation.ConversationEngine backed by the stub Gemini and TTS
+engines, and reports turn latency, throughput and the number of threads in use
+for each level of concurrency. Results are written as JSON.
+
+Usage:
+    python benchmarks/bench_engine.py --sessions 1,16,64,256 --output bench_results_engine.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from services.conversation import ConversationEngine  # noqa: E402
+from services.llm import FakeGenerativeModel, RequestScheduler  # noqa: E402
+from services.tts import FakeTTSEngine, TTSCache  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", default="1,16,64,256", help="Comma-separated numbers of concurrent sessions")
+    parser.add_argument("--voice", default="off,on", help="Voice responses settings to test: off, on or both")
+    parser.add_argument("--max-in-flight", type=int, default=32, help="Gemini requests the scheduler runs at once")
+    parser.add_argument("--llm-latency", type=float, default=0.005, help="Stub Gemini delay per streamed word (s)")
+    parser.add_argument("--tts-latency", type=float, default=0.05, help="Stub text-to-speech delay per call (s)")
+    parser.add_argument("--output", default="bench_results_engine.json", help="Where to write the JSON results")
+    return parser.parse_args()
+
+
+def bench_level(args, sessions, voice):
+    model = FakeGenerativeModel(chunk_delay=args.llm_latency)
+    engine = ConversationEngine(
+        RequestScheduler(max_in_flight=args.max_in_flight),
+        tts_cache=TTSCache(tempfile.mkdtemp(prefix="bench-engine-tts-")),
+        synthesize=FakeTTSEngine(latency=args.tts_latency),
+        tts_executor=ThreadPoolExecutor(max_workers=8, thread_name_prefix="tts"),
+        voice="fake"
+    )
+
+    start = time.perf_counter()
+    turns = [
+        # Every session asks something different, so no requests are merged
+        engine.submit(model.start_chat(), "", [], prompt=f"Question {i} from session {i}. Please answer it.",
+                      tts_lang_code="en", voice=voice)
+        for i in range(sessions)
+    ]
+    peak_threads = threading.active_count()
+    latencies = []
+    running = turns
+    while running:
+        time.sleep(0.001)
+        now = time.perf_counter()
+        peak_threads = max(peak_threads, threading.active_count())
+        latencies.extend(now - start for turn in running if turn.done)
+        running = [turn for turn in running if not turn.done]
+    wall = time.perf_counter() - start
+
+    stats = engine.stats()
+    engine.close()
+    latencies.sort()
+    return {
+        "sessions": sessions,
+        "voice_responses": voice,
+        "wall_seconds": wall,
+        "turns_per_second": sessions / wall,
+        "turn_p50_seconds": statistics.median(latencies),
+        "turn_max_seconds": latencies[-1],
+        "peak_threads": peak_threads,
+        "done": stats["done"],
+        "failed": stats["failed"],
+    }
+
+
+def main():
+    args = parse_args()
+    levels = [int(sessions) for sessions in args.sessions.split(",") if sessions]
+    voices = [setting == "on" for setting in args.voice.split(",") if setting]
+
+    results = []
+    for sessions in levels:
+        for voice in voices:
+            result = bench_level(args, sessions, voice)
+            results.append(result)
+            print(
+                f"sessions={sessions:4d} voice={'on ' if voice else 'off'} "
+                f"wall={result['wall_seconds'] * 1000:8.1f} ms "
+                f"turns/s={result['turns_per_second']:7.1f} "
+                f"turn p50={result['turn_p50_seconds'] * 1000:8.1f} ms "
+                f"threads={result['peak_threads']:4d} failed={result['failed']}"
+            )
+
+    report = {
+        "benchmark": "engine",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "max_in_flight": args.max_in_flight,
+            "llm_latency": args.llm_latency,
+            "tts_latency": args.tts_latency,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
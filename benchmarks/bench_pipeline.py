@@ -0,0 +1,275 @@
+"""Headless end-to-end benchmark of the conversation pipeline.
+
+Drives app.py with Streamlit's AppTest against stub Gemini, speech-to-text and
+text-to-speech backends (no network needed) and measures idle rerun time, turn
+latency and peak memory as a function of conversation length, voice responses
+and input mode. Results are written as JSON.
+
+Usage:
+    python benchmarks/bench_pipeline.py --lengths 0,20,100 --output bench_results.json
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "app.py")
+MODES = ["text", "manual", "flow", "automatic"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lengths", default="0,20,100",
+                        help="Comma-separated conversation lengths (messages already in history)")
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma-separated modes: " + ", ".join(MODES))
+    parser.add_argument("--voice", default="off,on", help="Voice responses settings to test: off, on or both")
+    parser.add_argument("--runs", type=int, default=3, help="Measured repetitions per configuration")
+    parser.add_argument("--llm-latency", type=float, default=0.005, help="Stub Gemini delay per streamed word (s)")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0,
+                        help="Fraction of stub Gemini requests that fail with a retryable error")
+    parser.add_argument("--stt-latency", type=float, default=0.05, help="Stub speech-to-text delay (s)")
+    parser.add_argument("--tts-latency", type=float, default=0.05, help="Stub text-to-speech delay per call (s)")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results")
+    return parser.parse_args()
+
+
+def configure_stubs(args):
+    """Point the app at the offline backends; must run before app.py is executed"""
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_CHUNK_DELAY"] = str(args.llm_latency)
+    os.environ["FAKE_LLM_FAILURE_RATE"] = str(args.llm_failure_rate)
+    os.environ["STT_ENGINE"] = "fake"
+    os.environ["FAKE_STT_LATENCY"] = str(args.stt_latency)
+    os.environ["TTS_ENGINE"] = "fake"
+    os.environ["FAKE_TTS_LATENCY"] = str(args.tts_latency)
+    # Keep stub audio out of the real cache and out of static/media
+    os.environ["TTS_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench-tts-")
+    os.environ["MEDIA_DIR"] = tempfile.mkdtemp(prefix="bench-media-")
+    # Benchmark conversations go to a throwaway session database
+    os.environ["SESSION_STORE"] = "sqlite"
+    os.environ["SESSION_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-sessions-"), "sessions.db")
+    # Repeated benchmark questions must reach the stub model, not the response cache
+    os.environ["RESPONSE_CACHE_SIZE"] = "0"
+    os.environ.pop("METRICS_PORT", None)
+    os.environ.pop("TRACE_LOG_PATH", None)
+    sys.path.insert(0, ROOT)
+
+
+def synthetic_recording(seed, seconds=1.0, sample_rate=16000):
+    """A short 16-bit mono WAV tone, different for every seed so it counts as a new recording"""
+    frequency = 200 + 10 * seed
+    frames = b"".join(
+        struct.pack("<h", int(6000 * math.sin(2 * math.pi * frequency * i / sample_rate)))
+        for i in range(int(seconds * sample_rate))
+    )
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+class RecorderStub:
+    """Replaces both recorder components; returns a recording only when armed"""
+
+    def __init__(self):
+        self.recording = None
+        self.utterance_id = 0
+
+    def arm(self, recording):
+        self.recording = recording
+        self.utterance_id += 1
+
+    def manual(self, **kwargs):
+        return self.recording
+
+    def automatic(self, **kwargs):
+        if self.recording is None:
+            return None
+        # The app asks for "pcm16" capture, so send the WAV's raw samples like the browser would
+        with wave.open(io.BytesIO(self.recording), "rb") as wav:
+            pcm = wav.readframes(wav.getnframes())
+            sample_rate = wav.getframerate()
+        return {
+            "utterance_id": self.utterance_id,
+            "segments": [{
+                "index": 0,
+                "audio": pcm,
+                "mime": "audio/pcm",
+                "sample_rate": sample_rate,
+                "duration": len(pcm) / (2 * sample_rate),
+                "vad": {"frames": 60, "speech_frames": 60, "peak_level": 0.2},
+            }],
+            "final": True,
+        }
+
+
+def install_recorder_stub():
+    import audio_recorder_streamlit
+    import components.continuous_voice_recorder as continuous
+
+    stub = RecorderStub()
+    audio_recorder_streamlit.audio_recorder = stub.manual
+    continuous.continuous_voice_recorder = stub.automatic
+    return stub
+
+
+def seed_session(length):
+    """Store a conversation of the given length and return its session id"""
+    from services.session_store import create_session_store
+
+    store = create_session_store("sqlite")
+    session_id = f"bench-{time.monotonic_ns()}"
+    for message in conversation(length):
+        store.append_message(session_id, message)
+    return session_id
+
+
+def conversation(length):
+    messages = []
+    for i in range(length):
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": f"Question number {i} about something?"})
+        else:
+            messages.append({
+                "role": "assistant",
+                "content": f"Here is **answer {i}**. It has a couple of sentences. And a list:\n- one\n- two",
+            })
+    return messages
+
+
+def summarize(samples):
+    return {
+        "mean": statistics.mean(samples),
+        "p50": statistics.median(samples),
+        "max": max(samples),
+        "samples": samples,
+    }
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_config(recorder, length, mode, voice, runs):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    # The app loads the conversation from the session store, like after a reload
+    at.query_params["session"] = seed_session(length)
+    at.session_state["enable_voice_response"] = voice
+    at.session_state["conversation_flow_mode"] = mode == "flow"
+    at.session_state["automatic_mode"] = mode == "automatic"
+
+    # Warm-up run: imports, cached resources and the first render
+    recorder.recording = None
+    at.run()
+    if at.exception:
+        raise RuntimeError(f"App raised during warm-up: {at.exception[0].value}")
+
+    rerun_times = [timed(at.run) for _ in range(runs)]
+    rerun_peak = peak_memory(at.run)
+
+    turn_times = []
+    turn_peaks = []
+    for i in range(runs + 1):
+        def turn():
+            if mode == "text":
+                at.chat_input[0].set_value(f"Benchmark question {i}").run()
+            else:
+                recorder.arm(synthetic_recording(len(at.session_state["messages"]) + i))
+                at.run()
+                recorder.recording = None
+            # The turn runs in the conversation engine; wait for it, then let the app pick it up
+            pending = at.session_state["pending_turn"]
+            if pending is not None:
+                pending.wait()
+                at.run()
+        # The last turn is traced for memory only, tracemalloc skews timings
+        if i < runs:
+            turn_times.append(timed(turn))
+        else:
+            turn_peaks.append(peak_memory(turn))
+        if at.exception:
+            raise RuntimeError(f"App raised during a turn: {at.exception[0].value}")
+
+    return {
+        "length": length,
+        "mode": mode,
+        "voice_responses": voice,
+        "rerun_seconds": summarize(rerun_times),
+        "turn_seconds": summarize(turn_times),
+        "rerun_peak_bytes": rerun_peak,
+        "turn_peak_bytes": max(turn_peaks),
+        "final_length": len(at.session_state["messages"]),
+    }
+
+
+def main():
+    args = parse_args()
+    configure_stubs(args)
+    recorder = install_recorder_stub()
+
+    lengths = [int(length) for length in args.lengths.split(",") if length]
+    modes = [mode for mode in args.modes.split(",") if mode]
+    voices = [setting == "on" for setting in args.voice.split(",") if setting]
+    for mode in modes:
+        if mode not in MODES:
+            raise SystemExit(f"Unknown mode {mode!r}, expected one of {', '.join(MODES)}")
+
+    results = []
+    for length in lengths:
+        for mode in modes:
+            for voice in voices:
+                result = bench_config(recorder, length, mode, voice, args.runs)
+                results.append(result)
+                print(
+                    f"length={length:4d} mode={mode:9s} voice={'on ' if voice else 'off'} "
+                    f"rerun p50={result['rerun_seconds']['p50'] * 1000:7.1f} ms "
+                    f"turn p50={result['turn_seconds']['p50'] * 1000:7.1f} ms "
+                    f"turn peak={result['turn_peak_bytes'] / 1024:8.0f} KiB"
+                )
+
+    report = {
+        "benchmark": "pipeline",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "runs": args.runs,
+            "llm_latency": args.llm_latency,
+            "llm_failure_rate": args.llm_failure_rate,
+            "stt_latency": args.stt_latency,
+            "tts_latency": args.tts_latency,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
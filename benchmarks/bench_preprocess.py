@@ -0,0 +1,131 @@
+"""Benchmark of the audio decoding and preprocessing stage before speech-to-text.
+
+Builds synthetic recordings (quiet noise, then speech-like harmonic bursts, then
+noise again) at several lengths and formats, and measures WAV decoding against
+speech_recognition's AudioFile reader, the cost of preprocess_audio (trim,
+normalize, resample) and how much audio is left to send to the recognizer.
+Results are written as JSON.
+
+Usage:
+    python benchmarks/bench_preprocess.py --seconds 2,5,15 --output bench_results_preprocess.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import wave
+
+import numpy as np
+import speech_recognition as sr
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from services.audio import decode_audio, preprocess_audio  # noqa: E402
+
+# (sample rate, channels) of the recordings: browser default, CD-quality stereo, recognizer rate
+FORMATS = [(48000, 1), (44100, 2), (16000, 1)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", default="2,5,15", help="Comma-separated speech lengths (s)")
+    parser.add_argument("--silence", type=float, default=1.0, help="Silence before and after the speech (s)")
+    parser.add_argument("--runs", type=int, default=5, help="Measured repetitions per clip")
+    parser.add_argument("--output", default="bench_results_preprocess.json", help="Where to write the JSON results")
+    return parser.parse_args()
+
+
+def synthetic_clip(speech_seconds, silence_seconds, sample_rate, channels, seed=0):
+    """16-bit WAV: faint noise around syllable-like bursts of a harmonic tone"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(speech_seconds * sample_rate)) / sample_rate
+    voice = sum(np.sin(2 * np.pi * 140 * k * t) / k for k in range(1, 6))
+    # Four syllables a second, with short gaps between words
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None) * (np.sin(2 * np.pi * 0.7 * t) > -0.8)
+    speech = 0.15 * voice * envelope
+
+    silence = np.zeros(int(silence_seconds * sample_rate))
+    mono = np.concatenate([silence, speech, silence])
+    mono += rng.normal(0, 0.002, len(mono))
+    frames = np.repeat(mono[:, None], channels, axis=1)
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((np.clip(frames, -1, 1) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def baseline_decode(data):
+    """What decode_audio used to do for WAV"""
+    with sr.AudioFile(io.BytesIO(data)) as source:
+        return sr.Recognizer().record(source)
+
+
+def best_of(func, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return {"min": min(samples), "p50": statistics.median(samples)}
+
+
+def bench_clip(speech_seconds, silence_seconds, sample_rate, channels, runs):
+    data = synthetic_clip(speech_seconds, silence_seconds, sample_rate, channels)
+    decoded = decode_audio(data)
+    processed = preprocess_audio(decoded)
+
+    return {
+        "speech_seconds": speech_seconds,
+        "sample_rate": sample_rate,
+        "channels": channels,
+        "input_bytes": len(data),
+        "baseline_decode_seconds": best_of(lambda: baseline_decode(data), runs),
+        "decode_seconds": best_of(lambda: decode_audio(data), runs),
+        "preprocess_seconds": best_of(lambda: preprocess_audio(decoded), runs),
+        "baseline_stt_bytes": len(baseline_decode(data).get_raw_data()),
+        "stt_bytes": len(processed.get_raw_data()),
+        "stt_seconds_of_audio": len(processed.get_raw_data()) / (2 * processed.sample_rate),
+    }
+
+
+def main():
+    args = parse_args()
+    lengths = [float(seconds) for seconds in args.seconds.split(",") if seconds]
+
+    results = []
+    for speech_seconds in lengths:
+        for sample_rate, channels in FORMATS:
+            result = bench_clip(speech_seconds, args.silence, sample_rate, channels, args.runs)
+            results.append(result)
+            print(
+                f"speech={speech_seconds:5.1f}s {sample_rate:5d} Hz x{channels} "
+                f"decode {result['baseline_decode_seconds']['p50'] * 1000:6.1f} -> "
+                f"{result['decode_seconds']['p50'] * 1000:6.1f} ms, "
+                f"preprocess {result['preprocess_seconds']['p50'] * 1000:6.1f} ms, "
+                f"STT audio {result['baseline_stt_bytes'] / 1024:7.0f} -> {result['stt_bytes'] / 1024:6.0f} KiB"
+            )
+
+    report = {
+        "benchmark": "preprocess",
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "settings": {"runs": args.runs, "silence_seconds": args.silence},
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
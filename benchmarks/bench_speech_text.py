@@ -0,0 +1,158 @@
+"""Microbenchmark of markdown-to-speech text normalization.
+
+Compares the regex-chain cleaner the app used to have (about 15 uncompiled
+re.sub passes per call) with services.speech_text, both on whole replies and on
+replies fed word by word as they stream from Gemini. Also reports whether code
+blocks leak into the spoken text. Results are written as JSON.
+
+Usage:
+    python benchmarks/bench_speech_text.py --sizes 1,5,20 --output bench_results_speech_text.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from services.speech_text import SpeechTextNormalizer, normalize_for_speech  # noqa: E402
+
+ENGLISH_BLOCK = """## Step {n}: Understanding the idea
+
+Here is **the key point** of step {n}. It uses `numpy.mean()` and a [reference](https://example.com/docs/a.b).
+Version 3.5 is *much* faster than before!
+
+```python
+def step_{n}(values):
+    # This comment must not be read aloud.
+    return sum(values) / len(values)
+```
+
+- First, read the question carefully.
+- Then, check the units.
+1. Write down what you know.
+2. Solve for the unknown.
+
+> Remember: practice makes perfect.
+"""
+
+CHINESE_BLOCK = """### 第{n}部分
+这是第{n}个解释。我们先看**重点**！你明白了吗？
+- 第一点
+- 第二点
+"""
+
+
+def legacy_clean_text_for_speech(text):
+    """The cleaner app.py used before services.speech_text, kept here as the baseline"""
+    import re
+
+    text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
+    text = re.sub(r'\*(.+?)\*', r'\1', text)
+    text = re.sub(r'__(.+?)__', r'\1', text)
+    text = re.sub(r'_(.+?)_', r'\1', text)
+    text = re.sub(r'`(.+?)`', r'\1', text)
+    text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
+    text = re.sub(r'\[(.+?)\]\(.+?\)', r'\1', text)
+    text = re.sub(r'^#+\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^\s*[-*+]\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^\s*\d+\.\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'[#|>]', '', text)
+    text = re.sub(r'\n+', '. ', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+
+LEGACY_SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|(?<=[。！？])|\n+')
+
+
+def legacy_streaming(chunks):
+    """The old SpeechPipeline split: re-split the buffer on every chunk, clean each sentence"""
+    buffer = ""
+    spoken = []
+    for chunk in chunks:
+        buffer += chunk
+        parts = LEGACY_SENTENCE_BOUNDARY.split(buffer)
+        buffer = parts.pop()
+        spoken.extend(legacy_clean_text_for_speech(part) for part in parts if part.strip())
+    if buffer.strip():
+        spoken.append(legacy_clean_text_for_speech(buffer))
+    return spoken
+
+
+def streaming(chunks):
+    normalizer = SpeechTextNormalizer()
+    spoken = []
+    for chunk in chunks:
+        spoken.extend(normalizer.feed(chunk))
+    spoken.extend(normalizer.close())
+    return spoken
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1,5,20", help="Comma-separated reply sizes, in blocks of each language")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions (best is reported)")
+    parser.add_argument("--output", default="bench_results_speech_text.json", help="Where to write the JSON results")
+    return parser.parse_args()
+
+
+def reply(size):
+    return "\n".join(ENGLISH_BLOCK.format(n=n) + CHINESE_BLOCK.format(n=n) for n in range(size))
+
+
+def word_chunks(text):
+    """Split a reply the way it streams: a word (with its leading whitespace) at a time"""
+    return re.findall(r'\s*\S+', text) + ([text[len(text.rstrip()):]] if text != text.rstrip() else [])
+
+
+def best_time(func, repeat):
+    number = max(1, int(0.2 / max(timeit.timeit(func, number=1), 1e-6)))
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    results = []
+    for size in sizes:
+        text = reply(size)
+        chunks = word_chunks(text)
+        result = {
+            "blocks": size,
+            "chars": len(text),
+            "chunks": len(chunks),
+            "legacy_full_seconds": best_time(lambda: legacy_clean_text_for_speech(text), args.repeat),
+            "full_seconds": best_time(lambda: normalize_for_speech(text), args.repeat),
+            "legacy_streaming_seconds": best_time(lambda: legacy_streaming(chunks), args.repeat),
+            "streaming_seconds": best_time(lambda: streaming(chunks), args.repeat),
+            "legacy_reads_code": "return sum" in legacy_clean_text_for_speech(text),
+            "reads_code": "return sum" in normalize_for_speech(text),
+        }
+        results.append(result)
+        print(
+            f"blocks={size:3d} chars={len(text):6d} "
+            f"full {result['legacy_full_seconds'] * 1e6:8.0f} -> {result['full_seconds'] * 1e6:8.0f} us, "
+            f"streaming {result['legacy_streaming_seconds'] * 1e6:9.0f} -> {result['streaming_seconds'] * 1e6:8.0f} us, "
+            f"code read aloud {result['legacy_reads_code']} -> {result['reads_code']}"
+        )
+
+    report = {
+        "benchmark": "speech_text",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"repeat": args.repeat},
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
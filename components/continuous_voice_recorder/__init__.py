@@ -1,4 +1,7 @@
+import json
 import os
+import struct
+import streamlit as st
 import streamlit.components.v1 as components
 
 # Create a _RELEASE constant
@@ -17,7 +20,37 @@ else:
     _component_func = components.declare_component("continuous_voice_recorder", path=build_dir)
 
 
-def continuous_voice_recorder(auto_start=False, silence_threshold=0.02, silence_duration=2.0, key=None):
+# Session state holding the utterance being received (one recorder per page)
+_STATE_KEY = "_continuous_voice_recorder"
+
+
+def _unpack_recording(payload):
+    """Split the component's binary value into its metadata and audio bytes.
+
+    The payload is a 4-byte little-endian header length, a JSON metadata header,
+    then the audio. In streaming mode the header lists the segments sent in this
+    value with their byte lengths, and their audio follows back to back.
+    """
+    payload = bytes(payload)
+    (header_length,) = struct.unpack_from("<I", payload)
+    recording = json.loads(payload[4:4 + header_length].decode("utf-8"))
+    audio = memoryview(payload)[4 + header_length:]
+
+    if "segments" not in recording:
+        recording["audio"] = bytes(audio)
+        return recording
+
+    offset = 0
+    for segment in recording["segments"]:
+        length = segment.pop("length")
+        segment["audio"] = bytes(audio[offset:offset + length])
+        offset += length
+    return recording
+
+
+def continuous_voice_recorder(auto_start=False, silence_threshold=0.01, silence_duration=0.8,
+                              stream_segments=False, segment_pause=0.4, capture_format="webm",
+                              pre_roll=0.3, key=None):
     """
     Continuous voice recorder component with Voice Activity Detection.
 
@@ -26,23 +59,95 @@ def continuous_voice_recorder(auto_start=False, silence_threshold=0.02, silence_
     auto_start : bool
         If True, automatically starts recording when component loads
     silence_threshold : float
-        Audio level threshold below which is considered silence (0.0 to 1.0)
+        Minimum RMS level (0.0 to 1.0) of a 20 ms frame that can count as speech.
+        Detection runs in an AudioWorklet and also tracks the background noise
+        floor, so in noisy rooms the effective threshold rises above this. Browsers
+        without AudioWorklet fall back to polling an AnalyserNode, without the floor
     silence_duration : float
-        Seconds of silence before stopping recording
+        Seconds of silence after speech before stopping recording (the hangover).
+        Recording never stops before the user has said something
+    stream_segments : bool
+        If True, cut the recording into segments at short pauses and send each one
+        as soon as it is complete, so they can be transcribed while the user speaks
+    segment_pause : float
+        Seconds of pause after speech that closes the current segment (streaming only)
+    capture_format : str
+        "webm" records Opus WebM with MediaRecorder. "pcm16" captures 16 kHz mono
+        16-bit little-endian PCM through an AudioWorklet (mime "audio/pcm"), which
+        speech recognition can use without decoding. Without AudioWorklet support
+        the browser records WebM instead; the mime says which format arrived
+    pre_roll : float
+        Seconds of audio before detected speech that are kept ("pcm16" only), so
+        the start of the first word isn't clipped
     key : str
         Unique key for the component
 
     Returns:
     --------
     dict or None
-        Audio data as base64 encoded string when recording stops, or None
+        The recording when it stops, or None: {"audio": bytes, "mime", "sample_rate",
+        "duration", "vad": {"frames", "speech_frames", "peak_level"}}.
+        In streaming mode: {"utterance_id", "segments": [...], "final"}, where each
+        segment has the same fields plus "index". The frontend only sends segments
+        this function hasn't received yet; they are collected in session state, so
+        "segments" always holds the whole utterance so far. Once the final utterance
+        has been returned its segments are dropped, and later reruns return None
+        for it. Only the latest key's utterance is kept, so use one recorder per page
     """
+    # Segments of the current utterance received so far, by index
+    received = st.session_state.get(_STATE_KEY)
+    if received is None or received["key"] != key:
+        received = {"key": key, "utterance_id": None, "segments": {}, "finished": False}
+        st.session_state[_STATE_KEY] = received
+
     component_value = _component_func(
         auto_start=auto_start,
         silence_threshold=silence_threshold,
         silence_duration=silence_duration,
+        stream_segments=stream_segments,
+        segment_pause=segment_pause,
+        capture_format=capture_format,
+        pre_roll=pre_roll,
+        # Acknowledge the segments received in a row, the frontend sends the ones after them
+        received_utterance=received["utterance_id"],
+        received_segments=_received_in_order(received["segments"]),
         key=key,
         default=None
     )
 
-    return component_value
+    # The frontend sends raw bytes; anything else is the default (or a stale value)
+    if not isinstance(component_value, (bytes, bytearray, memoryview)):
+        return None
+    recording = _unpack_recording(component_value)
+    if "segments" not in recording:
+        return recording
+
+    if recording["utterance_id"] != received["utterance_id"]:
+        received["utterance_id"] = recording["utterance_id"]
+        received["segments"] = {}
+        received["finished"] = False
+    elif received["finished"]:
+        # The component keeps returning its last value on every rerun
+        return None
+    for segment in recording["segments"]:
+        received["segments"][segment["index"]] = segment
+
+    segments = [received["segments"][index] for index in sorted(received["segments"])]
+    # Only final once every segment up to the last one has arrived
+    final = recording["final"] and _received_in_order(received["segments"]) == len(segments)
+    if final:
+        received["segments"] = {}
+        received["finished"] = True
+    return {
+        "utterance_id": recording["utterance_id"],
+        "segments": segments,
+        "final": final,
+    }
+
+
+def _received_in_order(segments):
+    """Count the segments received without a gap from index 0"""
+    count = 0
+    while count in segments:
+        count += 1
+    return count
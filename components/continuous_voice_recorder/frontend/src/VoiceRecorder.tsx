@@ -9,27 +9,371 @@ interface VoiceRecorderArgs {
   auto_start?: boolean
   silence_threshold?: number
   silence_duration?: number
+  stream_segments?: boolean
+  segment_pause?: number
+  capture_format?: string
+  pre_roll?: number
+  // Segments of this utterance the server has received in a row, from index 0
+  received_utterance?: number | null
+  received_segments?: number
+}
+
+// Per-recording voice activity statistics, sent along with the audio
+interface VadStats {
+  frames: number
+  speech_frames: number
+  peak_level: number
+}
+
+interface RecordingMetadata {
+  mime: string
+  sample_rate: number
+  duration: number
+  vad: VadStats
+}
+
+interface AudioSegment extends RecordingMetadata {
+  index: number
+  audio: Uint8Array
+}
+
+// Sample rate of "pcm16" captures, what speech recognizers expect
+const PCM_SAMPLE_RATE = 16000
+
+// 20 ms speech frames in a row that count as the start of speech (filters clicks)
+const ONSET_FRAMES = 3
+
+// AudioWorklet that runs voice activity detection on the audio thread, so it is
+// neither throttled in background tabs nor allocating per frame.
+//
+// Each 20 ms frame is speech when its RMS level is over both silence_threshold and
+// three times an adaptive noise floor, and noise-like frames (many zero crossings)
+// must be louder still. After speech it posts "pause" once segment_pause of silence
+// has passed and "end" after the hangover (silence_duration).
+//
+// With capture on it also downmixes to mono, downsamples to 16 kHz (averaging each
+// output sample's input window) and posts 16-bit PCM in batches. Outside speech the
+// samples go to a pre-roll ring buffer that is prepended at the next onset, so word
+// starts aren't clipped and silence between segments isn't sent; "flush" posts the rest.
+const VOICE_CAPTURE_WORKLET = `
+class VoiceCaptureProcessor extends AudioWorkletProcessor {
+  constructor(options) {
+    super()
+    const settings = options.processorOptions
+
+    this.frameSize = Math.round(sampleRate * 0.02)
+    this.frameSeconds = this.frameSize / sampleRate
+    this.frameEnergy = 0
+    this.frameCrossings = 0
+    this.frameFill = 0
+    this.lastSample = 0
+    this.minLevel = settings.minLevel
+    this.noiseFloor = settings.minLevel / 2
+    this.onsetFrames = settings.onsetFrames
+    this.segmentPause = settings.segmentPause
+    this.hangover = settings.hangover
+    this.speechRun = 0
+    this.silenceRun = 0
+    this.heardSpeech = false
+    this.paused = false
+    this.recording = false
+    this.stats = { frames: 0, speech_frames: 0, peak_level: 0 }
+
+    this.capture = settings.capture
+    this.step = sampleRate / settings.targetRate
+    this.untilNext = this.step
+    this.sum = 0
+    this.count = 0
+    this.batch = new Int16Array(settings.batchSize)
+    this.length = 0
+    this.ring = new Int16Array(Math.max(1, Math.round(settings.preRoll * settings.targetRate)))
+    this.ringStart = 0
+    this.ringLength = 0
+
+    this.port.onmessage = (event) => {
+      if (event.data === "flush") this.post(true)
+    }
+  }
+
+  post(last) {
+    this.port.postMessage({ type: "samples", samples: this.batch.slice(0, this.length), last: last })
+    this.length = 0
+  }
+
+  emit(value) {
+    if (this.recording) {
+      this.batch[this.length++] = value
+      if (this.length === this.batch.length) this.post(false)
+      return
+    }
+    this.ring[(this.ringStart + this.ringLength) % this.ring.length] = value
+    if (this.ringLength < this.ring.length) {
+      this.ringLength++
+    } else {
+      this.ringStart = (this.ringStart + 1) % this.ring.length
+    }
+  }
+
+  send(event) {
+    if (event !== "speech") {
+      // Hand over the samples first, so the segment is cut exactly here
+      if (this.capture && this.recording && this.length > 0) this.post(false)
+      this.recording = false
+    }
+    this.port.postMessage({ type: "vad", event: event, stats: this.stats })
+    if (event !== "speech") this.stats = { frames: 0, speech_frames: 0, peak_level: 0 }
+  }
+
+  onset() {
+    this.recording = true
+    this.heardSpeech = true
+    for (let i = 0; i < this.ringLength; i++) {
+      this.emit(this.ring[(this.ringStart + i) % this.ring.length])
+    }
+    this.ringStart = 0
+    this.ringLength = 0
+    this.send("speech")
+  }
+
+  endFrame() {
+    const level = Math.sqrt(this.frameEnergy / this.frameSize)
+    const crossingRate = this.frameCrossings / this.frameSize
+    this.frameEnergy = 0
+    this.frameCrossings = 0
+    this.frameFill = 0
+
+    const threshold = Math.max(this.minLevel, this.noiseFloor * 3)
+    const speech = level > threshold && (crossingRate < 0.25 || level > threshold * 2)
+    if (!speech) {
+      // The floor follows quieter noise quickly and louder noise slowly
+      this.noiseFloor += (level - this.noiseFloor) * (level < this.noiseFloor ? 0.2 : 0.02)
+    }
+
+    this.stats.frames++
+    this.stats.peak_level = Math.max(this.stats.peak_level, level)
+    if (speech) this.stats.speech_frames++
+
+    this.speechRun = speech ? this.speechRun + 1 : 0
+    if (speech && (this.recording || this.speechRun >= this.onsetFrames)) {
+      if (!this.recording) this.onset()
+      this.silenceRun = 0
+      this.paused = false
+      return
+    }
+    if (!this.heardSpeech) return
+
+    this.silenceRun++
+    const silence = this.silenceRun * this.frameSeconds
+    if (silence >= this.hangover) {
+      this.heardSpeech = false
+      this.send("end")
+    } else if (this.segmentPause > 0 && !this.paused && silence >= this.segmentPause) {
+      this.paused = true
+      this.send("pause")
+    }
+  }
+
+  process(inputs) {
+    const channels = inputs[0]
+    if (!channels || channels.length === 0) return true
+    for (let i = 0; i < channels[0].length; i++) {
+      let sample = 0
+      for (let c = 0; c < channels.length; c++) sample += channels[c][i]
+      sample /= channels.length
+
+      this.frameEnergy += sample * sample
+      if ((sample >= 0) !== (this.lastSample >= 0)) this.frameCrossings++
+      this.lastSample = sample
+      if (++this.frameFill === this.frameSize) this.endFrame()
+
+      if (!this.capture) continue
+      this.sum += sample
+      this.count++
+      this.untilNext -= 1
+      if (this.untilNext <= 0) {
+        const value = Math.max(-1, Math.min(1, this.sum / this.count))
+        this.emit(value < 0 ? value * 0x8000 : value * 0x7fff)
+        this.sum = 0
+        this.count = 0
+        this.untilNext += this.step
+      }
+    }
+    return true
+  }
+}
+registerProcessor("voice-capture", VoiceCaptureProcessor)
+`
+
+// Load worklet code kept in this bundle, so the component needs no extra static file
+const loadWorklet = async (audioContext: AudioContext, code: string) => {
+  const url = URL.createObjectURL(new Blob([code], { type: "application/javascript" }))
+  try {
+    await audioContext.audioWorklet.addModule(url)
+  } finally {
+    URL.revokeObjectURL(url)
+  }
+}
+
+// Pack metadata and audio into one binary component value: a 4-byte little-endian
+// header length, the JSON metadata header, then the audio bytes back to back
+const packPayload = (metadata: object, audio: Uint8Array[]): Uint8Array => {
+  const header = new TextEncoder().encode(JSON.stringify(metadata))
+  const audioLength = audio.reduce((sum, part) => sum + part.length, 0)
+  const payload = new Uint8Array(4 + header.length + audioLength)
+  new DataView(payload.buffer).setUint32(0, header.length, true)
+  payload.set(header, 4)
+  let offset = 4 + header.length
+  audio.forEach(part => {
+    payload.set(part, offset)
+    offset += part.length
+  })
+  return payload
 }
 
 const ContinuousVoiceRecorder: React.FC<ComponentProps> = (props) => {
   console.log("ContinuousVoiceRecorder props:", props)
   const args = (props.args as VoiceRecorderArgs) || {}
-  const { auto_start = false, silence_threshold = 0.02, silence_duration = 2.0 } = args
-  console.log("Parsed args:", { auto_start, silence_threshold, silence_duration })
+  const {
+    auto_start = false,
+    silence_threshold = 0.01,
+    silence_duration = 0.8,
+    stream_segments = false,
+    segment_pause = 0.4,
+    capture_format = "webm",
+    pre_roll = 0.3,
+  } = args
+  console.log("Parsed args:", { auto_start, silence_threshold, silence_duration, stream_segments, segment_pause, capture_format, pre_roll })
 
   const [isRecording, setIsRecording] = useState(false)
   const [status, setStatus] = useState<string>("Ready")
 
   const mediaRecorderRef = useRef<MediaRecorder | null>(null)
-  const audioChunksRef = useRef<Blob[]>([])
   const streamRef = useRef<MediaStream | null>(null)
   const audioContextRef = useRef<AudioContext | null>(null)
+  const workletNodeRef = useRef<AudioWorkletNode | null>(null)
+  // Fallback VAD for browsers without AudioWorklet
   const analyserRef = useRef<AnalyserNode | null>(null)
-  const silenceTimerRef = useRef<NodeJS.Timeout | null>(null)
   const animationFrameRef = useRef<number | null>(null)
+  // Worklet messages read this ref, since the isRecording state they close over goes stale
+  const isRecordingRef = useRef(false)
+
+  // Streaming mode: the utterance is cut into segments at short pauses
+  const utteranceIdRef = useRef<number>(0)
+  const segmentsRef = useRef<AudioSegment[]>([])
+  const segmentCountRef = useRef(0)
+  const finalizingRef = useRef(false)
+  // Read when sending, so a segment is only sent again until the server has it
+  const receivedRef = useRef({ utterance: args.received_utterance, segments: args.received_segments || 0 })
+  receivedRef.current = { utterance: args.received_utterance, segments: args.received_segments || 0 }
+  // Statistics of the segment that was just cut, from the worklet
+  const vadStatsRef = useRef<VadStats>({ frames: 0, speech_frames: 0, peak_level: 0 })
+
+  // "pcm16" capture: the samples of the current segment, posted by the worklet
+  const pcmCaptureRef = useRef(false)
+  const pcmChunksRef = useRef<Int16Array[]>([])
+
+  // Send one finished recording (the whole utterance, or one segment of it) to Streamlit
+  // as raw bytes, which skips base64 encoding on both ends and a third of the payload
+  const sendRecording = useCallback((audio: Uint8Array, index: number, final: boolean,
+                                     metadata: RecordingMetadata) => {
+    if (!stream_segments) {
+      // Send to Streamlit
+      Streamlit.setComponentValue(packPayload({ ...metadata, timestamp: Date.now() }, [audio]))
+      return
+    }
+
+    // A rerun only sees the latest value, so segments the server hasn't acknowledged yet
+    // are sent again; acknowledged ones are dropped, so the payload stays one or two segments
+    const received = receivedRef.current
+    const acknowledged = received.utterance === utteranceIdRef.current ? received.segments : 0
+    segmentsRef.current.push({ ...metadata, index: index, audio: audio })
+    segmentsRef.current = segmentsRef.current
+      .filter(segment => segment.index >= acknowledged)
+      .sort((a, b) => a.index - b.index)
+    const segments = segmentsRef.current.map(({ audio, ...segment }) => ({ ...segment, length: audio.length }))
+    Streamlit.setComponentValue(packPayload({
+      utterance_id: utteranceIdRef.current,
+      segments: segments,
+      final: final,
+      timestamp: Date.now()
+    }, segmentsRef.current.map(segment => segment.audio)))
+  }, [stream_segments])
+
+  // Start a MediaRecorder on the open stream, each one produces a self-contained file
+  const startMediaRecorder = useCallback((stream: MediaStream) => {
+    const mediaRecorder = new MediaRecorder(stream, {
+      mimeType: "audio/webm;codecs=opus"
+    })
+    const chunks: Blob[] = []
+    const startedAt = performance.now()
+    // Read now, the audio context is already closed when the last recorder stops
+    const sampleRate = audioContextRef.current ? audioContextRef.current.sampleRate : 0
+
+    mediaRecorderRef.current = mediaRecorder
+
+    mediaRecorder.ondataavailable = (event) => {
+      if (event.data.size > 0) {
+        chunks.push(event.data)
+      }
+    }
+
+    mediaRecorder.onstop = () => {
+      const audioBlob = new Blob(chunks, { type: "audio/webm" })
+      // Only the recorder that was running when recording stopped holds the last segment
+      const final = mediaRecorderRef.current === mediaRecorder && finalizingRef.current
+      const index = segmentCountRef.current++
+      const metadata = {
+        mime: mediaRecorder.mimeType || "audio/webm",
+        sample_rate: sampleRate,
+        duration: (performance.now() - startedAt) / 1000,
+        vad: vadStatsRef.current
+      }
+      audioBlob.arrayBuffer().then(buffer => sendRecording(new Uint8Array(buffer), index, final, metadata))
+    }
+
+    mediaRecorder.start()
+  }, [sendRecording])
+
+  // Send the PCM captured since the last cut as one recording
+  const finishPcmSegment = useCallback((final: boolean) => {
+    const chunks = pcmChunksRef.current
+    const samples = chunks.reduce((sum, chunk) => sum + chunk.length, 0)
+    const audio = new Uint8Array(samples * 2)
+    let offset = 0
+    chunks.forEach(chunk => {
+      audio.set(new Uint8Array(chunk.buffer, chunk.byteOffset, chunk.byteLength), offset)
+      offset += chunk.byteLength
+    })
+
+    pcmChunksRef.current = []
+    sendRecording(audio, segmentCountRef.current++, final, {
+      mime: "audio/pcm",
+      sample_rate: PCM_SAMPLE_RATE,
+      duration: samples / PCM_SAMPLE_RATE,
+      vad: vadStatsRef.current
+    })
+  }, [sendRecording])
+
+  // Close the current segment at a pause and keep recording into a new one
+  const cutSegment = useCallback(() => {
+    const stream = streamRef.current
+    if (!stream || !isRecordingRef.current) return
+
+    if (pcmCaptureRef.current) {
+      finishPcmSegment(false)
+      return
+    }
+    if (mediaRecorderRef.current && mediaRecorderRef.current.state !== "inactive") {
+      mediaRecorderRef.current.stop()
+    }
+    startMediaRecorder(stream)
+  }, [startMediaRecorder, finishPcmSegment])
 
   // Stop recording
   const stopRecording = useCallback(() => {
+    isRecordingRef.current = false
+    finalizingRef.current = true
+
     if (mediaRecorderRef.current && mediaRecorderRef.current.state !== "inactive") {
       mediaRecorderRef.current.stop()
     }
@@ -39,57 +383,151 @@ const ContinuousVoiceRecorder: React.FC<ComponentProps> = (props) => {
       streamRef.current = null
     }
 
-    if (audioContextRef.current) {
-      audioContextRef.current.close()
-      audioContextRef.current = null
+    if (animationFrameRef.current !== null) {
+      cancelAnimationFrame(animationFrameRef.current)
+      animationFrameRef.current = null
     }
-
-    if (silenceTimerRef.current) {
-      clearTimeout(silenceTimerRef.current)
-      silenceTimerRef.current = null
+    if (analyserRef.current) {
+      analyserRef.current.disconnect()
+      analyserRef.current = null
     }
 
-    if (animationFrameRef.current) {
-      cancelAnimationFrame(animationFrameRef.current)
-      animationFrameRef.current = null
+    const workletNode = workletNodeRef.current
+    workletNodeRef.current = null
+    if (workletNode && pcmCaptureRef.current) {
+      // The worklet posts its last samples, then the message handler closes the context
+      workletNode.port.postMessage("flush")
+    } else {
+      if (workletNode) {
+        workletNode.disconnect()
+      }
+      if (audioContextRef.current) {
+        audioContextRef.current.close()
+      }
     }
+    audioContextRef.current = null
 
     setIsRecording(false)
     setStatus("Processing...")
   }, [])
 
-  // Voice Activity Detection
-  const checkAudioLevel = useCallback(() => {
-    if (!analyserRef.current) return
+  // React to the voice activity detector's events, from either implementation
+  const handleVadEvent = useCallback((event: string, stats: VadStats) => {
+    if (!isRecordingRef.current) return
+    if (event === "speech") {
+      setStatus("🗣️ Hearing you...")
+      return
+    }
+    vadStatsRef.current = stats
+    if (event === "pause") {
+      setStatus("🔴 Listening...")
+      cutSegment()
+    } else if (event === "end") {
+      stopRecording()
+    }
+  }, [cutSegment, stopRecording])
+
+  // Voice Activity Detection (and "pcm16" capture) in an AudioWorklet
+  const startVoiceWorklet = useCallback(async (audioContext: AudioContext, source: MediaStreamAudioSourceNode) => {
+    await loadWorklet(audioContext, VOICE_CAPTURE_WORKLET)
+    const workletNode = new AudioWorkletNode(audioContext, "voice-capture", {
+      numberOfInputs: 1,
+      numberOfOutputs: 0,
+      processorOptions: {
+        minLevel: silence_threshold,
+        onsetFrames: ONSET_FRAMES,
+        segmentPause: stream_segments ? segment_pause : 0,
+        hangover: silence_duration,
+        capture: pcmCaptureRef.current,
+        targetRate: PCM_SAMPLE_RATE,
+        batchSize: PCM_SAMPLE_RATE / 10,
+        preRoll: pre_roll
+      }
+    })
+
+    workletNode.port.onmessage = (event) => {
+      const message = event.data
+      if (message.type === "samples") {
+        pcmChunksRef.current.push(message.samples)
+        if (message.last) {
+          // The worklet has handed over everything it buffered, so the context can go
+          finishPcmSegment(true)
+          workletNode.disconnect()
+          audioContext.close()
+        }
+        return
+      }
 
-    const dataArray = new Uint8Array(analyserRef.current.frequencyBinCount)
-    analyserRef.current.getByteFrequencyData(dataArray)
+      handleVadEvent(message.event, message.stats)
+    }
 
-    // Calculate average volume
-    const average = dataArray.reduce((sum, value) => sum + value, 0) / dataArray.length
-    const normalizedLevel = average / 255
+    source.connect(workletNode)
+    workletNodeRef.current = workletNode
+  }, [silence_threshold, silence_duration, stream_segments, segment_pause, pre_roll,
+      finishPcmSegment, handleVadEvent])
+
+  // Fallback for browsers without AudioWorklet: poll an AnalyserNode every animation
+  // frame with the same onset, pause and hangover rules (without the adaptive noise
+  // floor). Animation frames are throttled in background tabs, so this is less precise
+  const startAnalyserVad = useCallback((audioContext: AudioContext, source: MediaStreamAudioSourceNode) => {
+    const analyser = audioContext.createAnalyser()
+    analyser.fftSize = 2048
+    source.connect(analyser)
+    analyserRef.current = analyser
+
+    const samples = new Float32Array(analyser.fftSize)
+    let stats: VadStats = { frames: 0, speech_frames: 0, peak_level: 0 }
+    let speechRun = 0
+    let inSpeech = false
+    let heardSpeech = false
+    let paused = false
+    let silenceStart = 0
+
+    const send = (event: string) => {
+      inSpeech = false
+      handleVadEvent(event, stats)
+      stats = { frames: 0, speech_frames: 0, peak_level: 0 }
+    }
 
-    // Check if audio level is below silence threshold
-    if (normalizedLevel < silence_threshold) {
-      // Start silence timer if not already started
-      if (!silenceTimerRef.current) {
-        silenceTimerRef.current = setTimeout(() => {
-          stopRecording()
-        }, silence_duration * 1000)
-      }
-    } else {
-      // Reset silence timer if audio detected
-      if (silenceTimerRef.current) {
-        clearTimeout(silenceTimerRef.current)
-        silenceTimerRef.current = null
+    const checkAudioLevel = () => {
+      if (!isRecordingRef.current || analyserRef.current !== analyser) return
+
+      analyser.getFloatTimeDomainData(samples)
+      let energy = 0
+      for (let i = 0; i < samples.length; i++) energy += samples[i] * samples[i]
+      const level = Math.sqrt(energy / samples.length)
+      const speech = level > silence_threshold
+
+      stats.frames++
+      stats.peak_level = Math.max(stats.peak_level, level)
+      if (speech) stats.speech_frames++
+
+      speechRun = speech ? speechRun + 1 : 0
+      if (speech && (inSpeech || speechRun >= ONSET_FRAMES)) {
+        if (!inSpeech) {
+          inSpeech = true
+          heardSpeech = true
+          handleVadEvent("speech", stats)
+        }
+        silenceStart = 0
+        paused = false
+      } else if (heardSpeech) {
+        const now = performance.now()
+        if (!silenceStart) silenceStart = now
+        const silence = (now - silenceStart) / 1000
+        if (silence >= silence_duration) {
+          heardSpeech = false
+          send("end")
+        } else if (stream_segments && !paused && silence >= segment_pause) {
+          paused = true
+          send("pause")
+        }
       }
-    }
 
-    // Continue monitoring
-    if (isRecording) {
       animationFrameRef.current = requestAnimationFrame(checkAudioLevel)
     }
-  }, [isRecording, silence_threshold, silence_duration, stopRecording])
+    checkAudioLevel()
+  }, [silence_threshold, silence_duration, stream_segments, segment_pause, handleVadEvent])
 
   // Start recording
   const startRecording = useCallback(async () => {
@@ -109,58 +547,39 @@ const ContinuousVoiceRecorder: React.FC<ComponentProps> = (props) => {
       // Set up audio context for VAD
       const audioContext = new (window.AudioContext || (window as any).webkitAudioContext)()
       audioContextRef.current = audioContext
+      // Without AudioWorklet, detection falls back to an AnalyserNode and capture to WebM
+      const useWorklet = Boolean(audioContext.audioWorklet)
 
       const source = audioContext.createMediaStreamSource(stream)
-      const analyser = audioContext.createAnalyser()
-      analyser.fftSize = 2048
-      analyserRef.current = analyser
-
-      source.connect(analyser)
 
-      // Set up media recorder
-      const mediaRecorder = new MediaRecorder(stream, {
-        mimeType: "audio/webm;codecs=opus"
-      })
-
-      mediaRecorderRef.current = mediaRecorder
-      audioChunksRef.current = []
-
-      mediaRecorder.ondataavailable = (event) => {
-        if (event.data.size > 0) {
-          audioChunksRef.current.push(event.data)
-        }
+      utteranceIdRef.current = Date.now()
+      segmentsRef.current = []
+      segmentCountRef.current = 0
+      finalizingRef.current = false
+      pcmCaptureRef.current = useWorklet && capture_format === "pcm16"
+      pcmChunksRef.current = []
+      vadStatsRef.current = { frames: 0, speech_frames: 0, peak_level: 0 }
+      isRecordingRef.current = true
+
+      // Start VAD monitoring, and the media recorder unless the worklet captures the audio
+      if (useWorklet) {
+        await startVoiceWorklet(audioContext, source)
+      } else {
+        startAnalyserVad(audioContext, source)
       }
-
-      mediaRecorder.onstop = async () => {
-        const audioBlob = new Blob(audioChunksRef.current, { type: "audio/webm" })
-
-        // Convert to base64
-        const reader = new FileReader()
-        reader.onloadend = () => {
-          const base64data = reader.result as string
-          // Send to Streamlit
-          Streamlit.setComponentValue({
-            audio: base64data,
-            timestamp: Date.now()
-          })
-        }
-        reader.readAsDataURL(audioBlob)
-
-        audioChunksRef.current = []
+      if (!pcmCaptureRef.current) {
+        startMediaRecorder(stream)
       }
 
-      mediaRecorder.start()
       setIsRecording(true)
       setStatus("🔴 Listening...")
 
-      // Start VAD monitoring
-      checkAudioLevel()
-
     } catch (error) {
       console.error("Error accessing microphone:", error)
+      isRecordingRef.current = false
       setStatus(`Error: ${error}`)
     }
-  }, [checkAudioLevel])
+  }, [capture_format, startVoiceWorklet, startAnalyserVad, startMediaRecorder])
 
   // Auto-start if requested
   useEffect(() => {
@@ -0,0 +1,208 @@
+# Audio decoding and preprocessing helpers
+import io
+import os
+import shutil
+import subprocess
+import wave
+
+import numpy as np
+import speech_recognition as sr
+
+# Preprocessing: 20 ms analysis frames; frames quieter than the loudest one by more
+# than SILENCE_RATIO (about -26 dB) count as silence when trimming
+FRAME_SECONDS = 0.02
+SILENCE_RATIO = 0.05
+MIN_SPEECH_LEVEL = 0.003
+TRIM_PADDING = 0.15
+TARGET_PEAK = 0.9
+MAX_GAIN = 20.0
+
+
+class AudioDecodeError(Exception):
+    """Raised when recorded audio cannot be decoded"""
+
+
+def sniff_format(data):
+    """Guess the container format of audio bytes from their magic number"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "wav"
+    if data[:4] == b"\x1a\x45\xdf\xa3":
+        # EBML header, which is what browsers' MediaRecorder produces
+        return "webm"
+    if data[:4] == b"OggS":
+        return "ogg"
+    if data[:4] == b"fLaC":
+        return "flac"
+    if data[:3] == b"ID3" or (len(data) > 1 and data[0] == 0xFF and data[1] & 0xE0 == 0xE0):
+        return "mp3"
+    return None
+
+
+def _ffmpeg_binary():
+    return os.getenv("FFMPEG_BINARY") or shutil.which("ffmpeg")
+
+
+def recording_audio(recording):
+    """Return the audio of a recorder payload, ready for decode_audio.
+
+    Raw PCM captures become sr.AudioData right away, since they need no decoding;
+    anything else stays as container bytes.
+    """
+    if recording.get("mime") == "audio/pcm":
+        return sr.AudioData(recording["audio"], recording["sample_rate"], 2)
+    return recording["audio"]
+
+
+def playable_audio(audio):
+    """Return bytes a browser can play for recorded audio (container bytes or sr.AudioData)"""
+    if isinstance(audio, sr.AudioData):
+        return audio.get_wav_data()
+    return audio
+
+
+def to_mono(samples, channels):
+    """Downmix interleaved samples to mono by averaging the channels"""
+    if channels == 1:
+        return samples
+    frames = len(samples) // channels
+    # Strided sums are much faster than mean(axis=1) over a (frames, 2) view
+    return sum(samples[c:frames * channels:channels] for c in range(channels)) / channels
+
+
+def resample(samples, source_rate, target_rate):
+    """Resample float samples by linear interpolation.
+
+    When downsampling, a moving average over each output sample's input window
+    removes most of what would alias.
+    """
+    if source_rate == target_rate or len(samples) == 0:
+        return samples
+    ratio = source_rate / target_rate
+    if ratio == int(ratio):
+        # Whole-number ratio (48 kHz to 16 kHz): average each group of input samples
+        step = int(ratio)
+        count = len(samples) // step
+        return sum(samples[k:count * step:step] for k in range(step)) / step
+
+    if ratio > 1:
+        width = int(np.ceil(ratio))
+        samples = np.convolve(samples, np.ones(width, dtype=samples.dtype) / width, mode="same")
+    positions = np.arange(int((len(samples) - 1) / ratio) + 1) * ratio
+    index = positions.astype(np.int64)
+    fraction = (positions - index).astype(samples.dtype)
+    following = np.minimum(index + 1, len(samples) - 1)
+    return samples[index] * (1 - fraction) + samples[following] * fraction
+
+
+def trim_silence(samples, sample_rate):
+    """Cut leading and trailing silence, found by frame energy, keeping a little padding"""
+    frame = int(sample_rate * FRAME_SECONDS)
+    count = len(samples) // frame
+    if count == 0:
+        return samples
+
+    levels = np.sqrt(np.mean(samples[:count * frame].reshape(count, frame) ** 2, axis=1))
+    voiced = np.flatnonzero(levels > max(MIN_SPEECH_LEVEL, levels.max() * SILENCE_RATIO))
+    if len(voiced) == 0:
+        # Nothing but silence, leave it for the recognizer to reject
+        return samples
+
+    padding = int(sample_rate * TRIM_PADDING)
+    start = max(0, voiced[0] * frame - padding)
+    end = min(len(samples), (voiced[-1] + 1) * frame + padding)
+    return samples[start:end]
+
+
+def normalize_gain(samples):
+    """Scale so the peak sits at TARGET_PEAK, amplifying by at most MAX_GAIN"""
+    peak = np.abs(samples).max() if len(samples) else 0.0
+    if peak == 0:
+        return samples
+    return samples * min(TARGET_PEAK / peak, MAX_GAIN)
+
+
+def _to_audio_data(samples, sample_rate):
+    """Pack float samples in [-1, 1] as 16-bit mono sr.AudioData"""
+    pcm = np.clip(np.round(samples * 32767), -32768, 32767).astype("<i2")
+    return sr.AudioData(pcm.tobytes(), sample_rate, 2)
+
+
+def preprocess_audio(audio_data, sample_rate=16000):
+    """Prepare decoded audio for speech recognition.
+
+    Trims leading and trailing silence, normalizes gain and resamples to
+    sample_rate, so recognizers get shorter, evenly loud 16-bit mono audio.
+    """
+    raw = audio_data.get_raw_data(convert_width=2)
+    samples = np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768
+    samples = resample(samples, audio_data.sample_rate, sample_rate)
+    samples = normalize_gain(trim_silence(samples, sample_rate))
+    return _to_audio_data(samples, sample_rate)
+
+
+def _decode_wav(data, sample_rate):
+    """Decode 8/16/32-bit PCM WAV with NumPy, downmixing to mono and resampling"""
+    with wave.open(io.BytesIO(data), "rb") as wav:
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        source_rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+
+    if width == 1:
+        # 8-bit WAV is unsigned
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width in (2, 4):
+        dtype = "<i2" if width == 2 else "<i4"
+        samples = np.frombuffer(frames, dtype=dtype).astype(np.float32) / float(2 ** (8 * width - 1))
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {width} bytes")
+
+    samples = resample(to_mono(samples, channels), source_rate, sample_rate)
+    return _to_audio_data(samples, sample_rate)
+
+
+def decode_audio(data, sample_rate=16000):
+    """Decode recorded audio bytes into sr.AudioData without touching the filesystem"""
+    if isinstance(data, sr.AudioData):
+        # Already PCM, e.g. a "pcm16" capture from the WebRTC recorder
+        return data
+
+    audio_format = sniff_format(data)
+
+    if audio_format == "wav":
+        try:
+            return _decode_wav(data, sample_rate)
+        except (wave.Error, ValueError):
+            # Less common WAV flavours (24-bit, float) go through speech_recognition
+            with sr.AudioFile(io.BytesIO(data)) as source:
+                return sr.Recognizer().record(source)
+
+    if audio_format is None:
+        raise AudioDecodeError("Unrecognized audio format")
+
+    # Compressed formats (WebM/Opus from the WebRTC recorder, Ogg, FLAC, MP3) go through
+    # an ffmpeg pipe that outputs 16-bit mono PCM at the recognizer's rate
+    ffmpeg = _ffmpeg_binary()
+    if ffmpeg is None:
+        raise AudioDecodeError(f"ffmpeg is required to decode {audio_format} audio")
+
+    result = subprocess.run(
+        [
+            ffmpeg, "-hide_banner", "-loglevel", "error",
+            "-f", audio_format, "-i", "pipe:0",
+            "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(sample_rate),
+            "pipe:1",
+        ],
+        input=data,
+        capture_output=True,
+    )
+    if result.returncode != 0 or not result.stdout:
+        message = result.stderr.decode("utf-8", errors="replace").strip() or "no audio decoded"
+        raise AudioDecodeError(f"Could not decode {audio_format} audio: {message}")
+
+    return sr.AudioData(result.stdout, sample_rate, 2)
+
+
+def decode_for_recognition(data, sample_rate=16000):
+    """Decode recorded audio and preprocess it for speech recognition"""
+    return preprocess_audio(decode_audio(data, sample_rate), sample_rate)
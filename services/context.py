@@ -0,0 +1,155 @@
+# Conversation context window
+import math
+import re
+import threading
+
+# Characters that Gemini tokenizes roughly one per token (CJK ideographs, kana, hangul)
+CJK_CHARS = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Given the previous summary and the next messages, write an updated summary that keeps "
+    "names, facts, preferences, decisions and open questions. Be concise and write in the "
+    "language of the conversation."
+)
+
+
+def estimate_tokens(text):
+    """Cheap local token estimate: ~4 characters per token, one per CJK character"""
+    cjk = len(CJK_CHARS.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def message_tokens(message):
+    # A few tokens of per-message overhead for role and separators
+    return estimate_tokens(message["content"]) + 4
+
+
+def summarize_conversation(model, previous_summary, messages):
+    """Fold messages into previous_summary with one non-streaming model call"""
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    prompt = (
+        f"Previous summary:\n{previous_summary or '(none)'}\n\n"
+        f"Next messages:\n{transcript}\n\n"
+        "Updated summary:"
+    )
+    return model.generate_content(prompt).text.strip()
+
+
+def conversation_history(messages):
+    """Return messages without error replies and the prompts that got them"""
+    history = []
+    for message in messages:
+        if message.get("error"):
+            if history and history[-1]["role"] == "user":
+                history.pop()
+        else:
+            history.append(message)
+    return history
+
+
+class ContextWindow:
+    """Keep the most recent turns verbatim within a token budget and summarize older ones.
+
+    When the unsummarized history goes over budget, the oldest turns (down to
+    keep_ratio of the budget) are folded into the running summary by a background
+    job. Until that job finishes they are still sent verbatim, so the turn never
+    waits on summarization.
+
+    build() takes the session's whole message list, error replies included, and
+    only reads it from the first unsummarized message on, so a long stored
+    conversation isn't loaded to answer the next turn. When a window starts on a
+    conversation of more than max_messages messages (one reopened from the
+    session store), the older ones are left out instead of summarized.
+    """
+
+    def __init__(self, budget_tokens, summarize, executor, keep_ratio=0.5, max_messages=200):
+        self.budget_tokens = budget_tokens
+        self.summarize = summarize
+        self.executor = executor
+        self.keep_ratio = keep_ratio
+        self.max_messages = max_messages
+        self.summary = ""
+        self.summarized_count = 0  # messages[:summarized_count] are covered by the summary (or left out)
+        self._summarized_tail = None
+        self._pending = None  # (Future, message count it covers, content of its last message)
+        self._lock = threading.Lock()
+
+    def _prefix_matches(self, messages):
+        if self.summarized_count == 0:
+            return True
+        if len(messages) < self.summarized_count:
+            return False
+        return messages[self.summarized_count - 1]["content"] == self._summarized_tail
+
+    def _skip_old(self, messages):
+        """Start a new window at most max_messages back, before a user message"""
+        if self.summarized_count or len(messages) <= self.max_messages:
+            return
+        first = len(messages) - self.max_messages
+        for offset, message in enumerate(messages[first:]):
+            if message["role"] == "user":
+                self.summarized_count = first + offset
+                self._summarized_tail = messages[self.summarized_count - 1]["content"]
+                return
+
+    def _collect(self, messages):
+        """Apply a finished background summary, if any"""
+        if self._pending is None or not self._pending[0].done():
+            return
+        future, count, tail = self._pending
+        self._pending = None
+        if future.exception() is not None:
+            # Try again on a later turn, the turns are still sent verbatim meanwhile
+            return
+        if len(messages) >= count and messages[count - 1]["content"] == tail:
+            self.summary = future.result()
+            self.summarized_count = count
+            self._summarized_tail = tail
+
+    def _schedule(self, messages, recent):
+        """Start summarizing the oldest turns if the verbatim part is over budget"""
+        total = sum(message_tokens(message) for message in conversation_history(recent))
+        if self._pending is not None or total <= self.budget_tokens:
+            return
+
+        # Drop turns from the front until the rest fits in keep_ratio of the budget,
+        # only cutting before a user message so question/answer pairs stay together
+        target = self.budget_tokens * self.keep_ratio
+        cut = self.summarized_count
+        for index, message in enumerate(recent):
+            if total <= target and message["role"] == "user":
+                break
+            # Always keep the latest exchange verbatim
+            if index >= len(recent) - 2:
+                break
+            # Failed turns (a prompt and its error reply) weren't counted
+            failed = message.get("error") or (index + 1 < len(recent) and recent[index + 1].get("error"))
+            if not failed:
+                total -= message_tokens(message)
+            cut = self.summarized_count + index + 1
+        if cut <= self.summarized_count:
+            return
+
+        older = conversation_history(recent[:cut - self.summarized_count])
+        future = self.executor.submit(self.summarize, self.summary, older)
+        self._pending = (future, cut, messages[cut - 1]["content"])
+
+    def reset(self):
+        self.summary = ""
+        self.summarized_count = 0
+        self._summarized_tail = None
+        self._pending = None
+
+    def build(self, messages):
+        """Return (summary, recent messages) to send as context, leaving out failed turns"""
+        with self._lock:
+            if not self._prefix_matches(messages):
+                # The conversation was cleared or edited behind the summary
+                self.reset()
+            self._skip_old(messages)
+            self._collect(messages)
+            recent = messages[self.summarized_count:]
+            self._schedule(messages, recent)
+            return self.summary, conversation_history(recent)
+
@@ -0,0 +1,293 @@
+# Conversation turns (speech-to-text, Gemini, text-to-speech) run off the Streamlit script thread
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import speech_recognition as sr
+
+from services.audio import decode_audio, preprocess_audio
+from services.llm import record_exchange, request_key
+from services.speech_text import normalize_for_speech
+from services.tracing import Tracer
+from services.tts import SpeechPipeline
+
+# Marks the end of a blocking iterator read on a worker thread
+_END = object()
+
+
+def build_system_prompt(base_prompt, language_name):
+    """Return a personality's system prompt with the language instruction added"""
+    if language_name != "English":
+        return f"{base_prompt}\n\nIMPORTANT: Please respond in {language_name}. The user is communicating in {language_name}, so respond naturally in {language_name}."
+    return base_prompt
+
+
+def chat_fingerprint(messages):
+    """Return (length, last message) so edits, clears and failed turns are detected"""
+    return len(messages), messages[-1]["content"] if messages else None
+
+
+def chat_history(summary, messages):
+    """Convert a conversation summary and the messages after it to Gemini's chat history"""
+    history = []
+    if summary:
+        history.append({"role": "user", "parts": [f"Summary of our conversation so far:\n{summary}"]})
+        history.append({"role": "model", "parts": ["Got it, I'll keep that in mind."]})
+    for message in messages:
+        # Gemini calls the assistant role 'model'
+        role = "model" if message["role"] == "assistant" else message["role"]
+        history.append({"role": role, "parts": [message["content"]]})
+    return history
+
+
+class ConversationTurn:
+    """One turn as the engine works on it, read by the UI while it runs.
+
+    status goes from "transcribing" (voice input only) and "waiting" (the pause
+    before a transcript is sent) to "thinking", then ends as "done", "failed" or
+    "cancelled". text holds the reply so far, and speech_segments() the audio of
+    its sentences synthesized so far (when voice was requested), so playback can
+    start before the reply is complete. Once done, audio holds the whole spoken
+    reply (when synthesis worked), under audio_key in the TTS cache.
+    """
+
+    def __init__(self, turn_id, prompt=None):
+        self.id = turn_id
+        self.prompt = prompt
+        self.status = "transcribing" if prompt is None else "thinking"
+        self.text = ""
+        self.cached = False
+        self.audio = None
+        self.audio_key = None
+        self.error = None
+        self._cancelled = False
+        self._loop = None
+        self._task = None  # Set on the event loop once the turn starts
+        self._speech = None  # The reply's SpeechPipeline, when voice was requested
+        self._finished = threading.Event()
+
+    @property
+    def done(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the turn has ended; returns whether it did"""
+        return self._finished.wait(timeout)
+
+    def speech_segments(self):
+        """Return the audio of the reply's sentences synthesized so far, in order"""
+        return self._speech.ready_segments() if self._speech is not None else []
+
+    def cancel(self):
+        """Stop the turn at its next step; a reply already being generated is left to finish unseen"""
+        self._cancelled = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._cancel_task)
+
+    def _cancel_task(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+class ConversationEngine:
+    """Run conversation turns as asyncio tasks on one event loop shared by every session.
+
+    A turn is a pipeline: transcribe the recording (if any), wait send_delay, get
+    the reply from the response cache or stream it from Gemini through the request
+    scheduler, and synthesize each sentence while later ones are still arriving.
+    Blocking steps run on a thread pool, so the loop itself only coordinates, and
+    a turn can be cancelled between any two steps or streamed chunks. Callers
+    submit a turn and poll the returned ConversationTurn; nothing here depends on
+    Streamlit.
+
+    A streaming reply keeps one pool thread waiting on its next chunk until it
+    ends, so at most max_workers turns stream at once; the others queue for a
+    thread. Size it to at least the scheduler's max_in_flight.
+    """
+
+    def __init__(self, scheduler, stt_engine=None, response_cache=None, tts_cache=None, synthesize=None,
+                 tts_executor=None, voice="gtts", tracer=None, max_workers=32):
+        self.scheduler = scheduler
+        self.stt_engine = stt_engine
+        self.response_cache = response_cache
+        self.tts_cache = tts_cache
+        self.synthesize = synthesize
+        self.tts_executor = tts_executor
+        self.voice = voice
+        self.tracer = tracer or Tracer()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._counts = {"active": 0, "done": 0, "failed": 0, "cancelled": 0}
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="turn")
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="conversation-engine", daemon=True).start()
+
+    def submit(self, chat, system_prompt, history, prompt=None, audio=None, transcriber=None,
+               speech_lang_code=None, tts_lang_code=None, voice=False, stream=True, send_delay=0.0, trace=None):
+        """Start a turn and return its ConversationTurn right away.
+
+        Give either the prompt, or the recording as audio bytes or as a transcriber
+        that already has its segments. history is the conversation chat holds,
+        for the request and cache keys.
+        """
+        turn = ConversationTurn(next(self._ids), prompt)
+        with self._lock:
+            self._counts["active"] += 1
+        coroutine = self._run(turn, chat, system_prompt, history, audio, transcriber, speech_lang_code,
+                              tts_lang_code, voice, stream, send_delay, trace or self.tracer.turn())
+        turn._loop = self._loop
+        asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        return turn
+
+    def close(self):
+        """Stop the event loop and the worker threads; turns still running are abandoned"""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        """Return the number of turns running and how the finished ones ended"""
+        with self._lock:
+            return dict(self._counts)
+
+    async def _blocking(self, func, *args):
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    async def _chunks(self, generator):
+        """Read a blocking generator on the thread pool, one item at a time.
+
+        If the reader is cancelled the generator is closed, once the read in
+        progress has returned (a running generator can't be closed).
+        """
+        future = None
+        try:
+            while True:
+                future = self._executor.submit(next, generator, _END)
+                chunk = await asyncio.wrap_future(future)
+                if chunk is _END:
+                    return
+                yield chunk
+        finally:
+            if future is not None:
+                future.add_done_callback(lambda _: generator.close())
+
+    async def _run(self, turn, chat, system_prompt, history, audio, transcriber, speech_lang_code,
+                   tts_lang_code, voice, stream, send_delay, trace):
+        turn._task = asyncio.current_task()
+        status = "failed"
+        try:
+            if turn._cancelled:
+                raise asyncio.CancelledError
+            if turn.prompt is None:
+                turn.prompt = await self._blocking(self._transcribe, audio, transcriber, speech_lang_code, trace)
+                turn.status = "waiting"
+                # A moment to read the transcript before it is sent (and cancel it)
+                with trace.span("countdown"):
+                    await asyncio.sleep(send_delay)
+            turn.status = "thinking"
+            await self._reply(turn, chat, system_prompt, history, tts_lang_code, voice, stream, trace)
+            status = "done"
+        except asyncio.CancelledError:
+            status = "cancelled"
+        except Exception as e:
+            turn.error = e
+        finally:
+            turn.status = status
+            trace.finish()
+            with self._lock:
+                self._counts["active"] -= 1
+                self._counts[status] += 1
+            turn._finished.set()
+
+    def _transcribe(self, audio_bytes, transcriber, language_code, trace):
+        """Return the transcript of a recording, or a placeholder the user can edit"""
+        try:
+            # Streamed utterances were transcribed segment by segment while the user spoke
+            if transcriber is not None:
+                with trace.span("stt"):
+                    return transcriber.finish()
+
+            # Decode in memory: WAV directly, WebM/Ogg from the WebRTC recorder through an ffmpeg pipe
+            with trace.span("decode"):
+                audio_data = decode_audio(audio_bytes)
+
+            # Trim silence and even out the level, so the recognizer gets less and cleaner audio
+            with trace.span("preprocess"):
+                audio_data = preprocess_audio(audio_data)
+
+            with trace.span("stt"):
+                return self.stt_engine.transcribe(audio_data, language_code)
+
+        except sr.UnknownValueError:
+            return "[unclear audio - please edit]"
+        except sr.RequestError as e:
+            return f"[Error: {e}]"
+        except Exception as e:
+            return f"[Error: {str(e)}]"
+
+    async def _reply(self, turn, chat, system_prompt, history, tts_lang_code, voice, stream, trace):
+        prompt = turn.prompt
+        pipeline = None
+        if voice:
+            # Synthesize each sentence while later ones are still being generated
+            pipeline = SpeechPipeline(tts_lang_code, self.tts_executor, cache=self.tts_cache,
+                                      synthesize=self.synthesize, voice=self.voice)
+            turn._speech = pipeline
+
+        # Questions asked before early in a conversation are answered without calling Gemini
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.key(system_prompt, history, prompt)
+            cached_reply = self.response_cache.get(cache_key)
+            if cached_reply is not None:
+                with trace.span("llm_cached"):
+                    record_exchange(chat, prompt, cached_reply)
+                turn.cached = True
+                turn.text = cached_reply
+                if pipeline is not None:
+                    pipeline.feed(cached_reply)
+                    await self._speak(turn, pipeline, tts_lang_code, trace)
+                return
+
+        # Identical requests in flight from other sessions share one call
+        key = request_key(system_prompt, history, prompt)
+        with trace.span("llm"):
+            if stream:
+                start = time.perf_counter()
+                chunks = self._chunks(self.scheduler.stream(chat, prompt, key))
+                try:
+                    async for chunk in chunks:
+                        if not turn.text:
+                            trace.record("llm_first_token", time.perf_counter() - start)
+                        turn.text += chunk
+                        if pipeline is not None:
+                            pipeline.feed(chunk)
+                finally:
+                    # Closes the scheduler's stream too, so a stopped turn frees its request slot
+                    await chunks.aclose()
+            else:
+                turn.text = await self._blocking(self.scheduler.send, chat, prompt, key)
+                if pipeline is not None:
+                    pipeline.feed(turn.text)
+
+        if self.response_cache is not None:
+            self.response_cache.put(cache_key, turn.text)
+        if pipeline is not None:
+            await self._speak(turn, pipeline, tts_lang_code, trace)
+
+    async def _speak(self, turn, pipeline, tts_lang_code, trace):
+        """Join the reply's audio and store it under the whole reply's cache key"""
+        pipeline.close()
+        try:
+            # Only the sentences still being synthesized after the text finished count here
+            with trace.span("tts"):
+                audio = await self._blocking(pipeline.audio)
+        except Exception:
+            # Leave it to the background queue to retry when the message is rendered
+            return
+        if self.tts_cache is not None:
+            turn.audio_key = self.tts_cache.make_key(normalize_for_speech(turn.text), tts_lang_code, self.voice)
+            self.tts_cache.put(turn.audio_key, audio)
+        turn.audio = audio
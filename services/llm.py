@@ -0,0 +1,441 @@
+# Gemini chat helpers
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+MODEL_NAME = "gemini-2.5-flash"
+
+
+def create_model(system_prompt, backend="gemini"):
+    """Build the chat model for a system prompt (backend "gemini", or "fake" for offline runs)"""
+    if backend == "fake":
+        return FakeGenerativeModel(
+            system_instruction=system_prompt,
+            chunk_delay=float(os.getenv("FAKE_LLM_CHUNK_DELAY", "0")),
+            failure_rate=float(os.getenv("FAKE_LLM_FAILURE_RATE", "0"))
+        )
+    if backend != "gemini":
+        raise ValueError(f"Unknown LLM backend: {backend}")
+
+    import google.generativeai as genai
+    return genai.GenerativeModel(MODEL_NAME, system_instruction=system_prompt)
+
+
+class TransientLLMError(Exception):
+    """A failure worth retrying, e.g. the fake model's injected rate-limit errors"""
+
+
+def is_transient_error(error):
+    """Check whether a failed request may succeed if sent again"""
+    if isinstance(error, (TransientLLMError, ConnectionError, TimeoutError)):
+        return True
+    try:
+        from google.api_core import exceptions
+    except ImportError:
+        return False
+    # 429, 500, 503 and 504 from the Gemini API
+    return isinstance(error, (exceptions.TooManyRequests, exceptions.InternalServerError,
+                              exceptions.ServiceUnavailable, exceptions.GatewayTimeout))
+
+
+def normalize_text(text):
+    """Fold case and whitespace and drop closing punctuation, so trivially different texts match"""
+    return " ".join(text.casefold().split()).rstrip(" .!?。！？")
+
+
+def request_key(system_prompt, history, prompt):
+    """Identify a chat request by everything the model sees: instructions, history and prompt"""
+    payload = json.dumps(
+        [
+            normalize_text(system_prompt),
+            [(message["role"], normalize_text(message["content"])) for message in history],
+            normalize_text(prompt),
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Replies to recently seen requests, for conversations that are still short.
+
+    Opening questions repeat across users of the same personality and language, so
+    requests whose history has at most max_history messages are keyed with
+    request_key and their replies kept for ttl seconds, up to max_entries (least
+    recently used evicted first). Longer conversations are never cached.
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600.0, max_history=4):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_history = max_history
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expiry time, reply), least recently used first
+
+    def key(self, system_prompt, history, prompt):
+        """Return the cache key for a request, or None if it shouldn't be cached"""
+        if self.max_entries <= 0 or len(history) > self.max_history:
+            return None
+        return request_key(system_prompt, history, prompt)
+
+    def get(self, key):
+        """Return the cached reply for key, or None"""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, reply):
+        if key is None or not reply:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Return hit/miss counters and the number of cached replies"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+def record_exchange(chat, prompt, text):
+    """Add a prompt and its reply to a chat's history, as if the chat had sent it"""
+    chat.history = list(chat.history) + [
+        {"role": "user", "parts": [prompt]},
+        {"role": "model", "parts": [text]},
+    ]
+
+
+def stream_reply(chat, prompt):
+    """Send a message with streaming enabled and yield the reply text chunk by chunk"""
+    response = iter(chat.send_message(prompt, stream=True))
+    try:
+        for chunk in response:
+            # Chunks that only carry metadata (e.g. safety ratings) have no text
+            try:
+                text = chunk.text
+            except ValueError:
+                continue
+            if text:
+                yield text
+    finally:
+        # Ends the underlying stream when the reply is abandoned
+        close = getattr(response, "close", None)
+        if close is not None:
+            close()
+
+
+class TokenBucket:
+    """Allow rate requests per second on average, in bursts of up to capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if needed; returns the seconds waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class _Request:
+    """One upstream request, whose chunks every coalesced caller reads.
+
+    Callers are counted as readers until they release it; once the last one has
+    gone before the reply ended, the request is abandoned and its producer stops.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.error = None
+        self.done = False
+        self.readers = 0
+        self.abandoned = False
+        self._condition = threading.Condition()
+
+    def emit(self, chunk):
+        """Add a chunk; returns False once nobody reads the reply any more"""
+        with self._condition:
+            self.chunks.append(chunk)
+            self._condition.notify_all()
+            return not self.abandoned
+
+    def release(self):
+        """Stop reading; the last reader to leave early abandons the request"""
+        with self._condition:
+            self.readers -= 1
+            if self.readers == 0 and not self.done:
+                self.abandoned = True
+
+    def finish(self, error=None):
+        with self._condition:
+            self.error = error
+            self.done = True
+            self._condition.notify_all()
+
+    def read(self):
+        """Yield the chunks as they arrive, raising the request's error at the end"""
+        index = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.done or index < len(self.chunks))
+                chunks = self.chunks[index:]
+                done = self.done
+            yield from chunks
+            index += len(chunks)
+            if done and index == len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class RequestScheduler:
+    """Process-wide gate that every Gemini request goes through.
+
+    Requests run on a pool of max_in_flight workers; the rest wait in its queue.
+    Sends are spaced by a token bucket (rate per second, bursts of burst), and
+    transient errors (429, 5xx, timeouts) are retried with exponential backoff and
+    full jitter, as long as no text has been passed on yet. Requests with the same
+    key that overlap share one upstream call: later callers read the chunks of the
+    first, and the exchange is recorded in their own chat afterwards. When every
+    caller of a streamed request has stopped reading, the stream is closed at its
+    next chunk (or the request dropped if it hasn't started), freeing its slot.
+    """
+
+    def __init__(self, max_in_flight=4, rate=None, burst=None, max_retries=3, backoff=0.5, max_backoff=8.0):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._bucket = TokenBucket(rate, burst or max_in_flight) if rate else None
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="llm")
+        self._lock = threading.Lock()
+        self._requests = {}  # key -> _Request in flight
+        self._queued = 0
+        self._in_flight = 0
+        self._counts = {"requests": 0, "coalesced": 0, "retries": 0, "failures": 0, "abandoned": 0}
+        self._throttled = 0.0
+
+    def _submit(self, produce, key):
+        """Start produce(emit) on a worker, or join the overlapping request with the same key.
+
+        Returns (request, whether this call started it).
+        """
+        with self._lock:
+            request = self._requests.get(key) if key is not None else None
+            if request is not None:
+                with request._condition:
+                    if not request.abandoned:
+                        request.readers += 1
+                        self._counts["coalesced"] += 1
+                        return request, False
+            request = _Request()
+            request.readers = 1
+            if key is not None:
+                self._requests[key] = request
+            self._queued += 1
+            self._counts["requests"] += 1
+        self._executor.submit(self._run, request, produce, key)
+        return request, True
+
+    def _run(self, request, produce, key):
+        with self._lock:
+            self._queued -= 1
+            self._in_flight += 1
+        error = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                if request.abandoned:
+                    break
+                if self._bucket is not None:
+                    waited = self._bucket.acquire()
+                    with self._lock:
+                        self._throttled += waited
+                try:
+                    produce(request.emit)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    # Text already shown can't be taken back, so only clean failures are retried
+                    if request.chunks or request.abandoned or attempt == self.max_retries or not is_transient_error(e):
+                        break
+                    with self._lock:
+                        self._counts["retries"] += 1
+                    time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                if request.abandoned:
+                    self._counts["abandoned"] += 1
+                elif error is not None:
+                    self._counts["failures"] += 1
+                if key is not None and self._requests.get(key) is request:
+                    del self._requests[key]
+            request.finish(error)
+
+    @staticmethod
+    def _send(chat, prompt, stream, emit):
+        if stream:
+            replies = stream_reply(chat, prompt)
+            try:
+                for text in replies:
+                    if not emit(text):
+                        # Nobody reads the rest, stop downloading it
+                        break
+            finally:
+                replies.close()
+        else:
+            emit(chat.send_message(prompt).text)
+
+    def stream(self, chat, prompt, key=None):
+        """Send prompt in chat and yield the reply text chunk by chunk.
+
+        Closing the generator before the end stops reading; the request is
+        abandoned when no other caller shares it.
+        """
+        request, started = self._submit(partial(self._send, chat, prompt, True), key)
+        reader = request.read()
+        parts = []
+        try:
+            for chunk in reader:
+                parts.append(chunk)
+                yield chunk
+        finally:
+            reader.close()
+            request.release()
+        if not started:
+            record_exchange(chat, prompt, "".join(parts))
+
+    def send(self, chat, prompt, key=None):
+        """Send prompt in chat and return the whole reply text"""
+        return "".join(self.stream(chat, prompt, key))
+
+    def call(self, func, *args):
+        """Run any other model call, e.g. a summary, under the same limits and retries"""
+        request, _ = self._submit(lambda emit: emit(func(*args)), None)
+        return next(request.read())
+
+    def stats(self):
+        """Return queue depth, requests in flight and cumulative counters"""
+        with self._lock:
+            return {
+                "queued": self._queued,
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "throttled_seconds": self._throttled,
+                **self._counts,
+            }
+
+
+class _FakeResponse:
+    """Minimal response/chunk object exposing .text like the Gemini SDK"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeChatSession:
+    """Offline chat session that replies with canned text, optionally streamed.
+
+    With a failure_rate on the model, sends fail at random with TransientLLMError,
+    like a rate-limited API.
+    """
+
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def _reply_for(self, prompt):
+        if self.model.reply is not None:
+            return self.model.reply
+        return f"You said: {prompt}. This is a test reply."
+
+    def _record(self, prompt, text):
+        self.history.append({"role": "user", "parts": [prompt]})
+        self.history.append({"role": "model", "parts": [text]})
+
+    def _stream(self, prompt, text):
+        for i, word in enumerate(text.split(" ")):
+            if self.model.chunk_delay:
+                time.sleep(self.model.chunk_delay)
+            yield _FakeResponse(word if i == 0 else " " + word)
+        self._record(prompt, text)
+
+    def send_message(self, content, stream=False):
+        self.model.maybe_fail()
+        text = self._reply_for(content)
+        if stream:
+            return self._stream(content, text)
+        if self.model.chunk_delay:
+            time.sleep(self.model.chunk_delay * len(text.split(" ")))
+        self._record(content, text)
+        return _FakeResponse(text)
+
+
+class FakeGenerativeModel:
+    """Drop-in replacement for genai.GenerativeModel used for offline testing"""
+
+    def __init__(self, model_name="fake-model", system_instruction=None, reply=None, chunk_delay=0.0,
+                 failure_rate=0.0, seed=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.reply = reply
+        self.chunk_delay = chunk_delay
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def maybe_fail(self):
+        """Count a call, raising an injected failure at failure_rate"""
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.failure_rate
+        if failed:
+            raise TransientLLMError("429 Resource exhausted (injected by the fake model)")
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    def generate_content(self, contents):
+        self.maybe_fail()
+        text = self.reply if self.reply is not None else f"Summary of: {str(contents)[-200:]}"
+        return _FakeResponse(text)
@@ -0,0 +1,92 @@
+# Content-addressed media files for Streamlit's static file serving
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+class MediaStore:
+    """Audio stored once per content hash in the app's static folder.
+
+    Players reference the files by URL (/app/static/...), so the bytes are no longer
+    registered with Streamlit's media file manager and sent again on every rerun.
+    A file's URL never changes and its content never changes at that URL, so browsers
+    can keep it cached and revalidate with the ETag Streamlit sends. The folder is
+    bounded by max_bytes, evicting the least recently used files first.
+    """
+
+    def __init__(self, directory, url_path, max_bytes=200 * 1024 * 1024):
+        self.directory = directory
+        self.url_path = url_path.rstrip("/")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # file name -> size in bytes, least recently used first
+        self._total_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        existing = [
+            entry for entry in os.scandir(directory)
+            if entry.is_file() and not entry.name.startswith(".") and not entry.name.endswith(".tmp")
+        ]
+        for entry in sorted(existing, key=lambda e: e.stat().st_mtime):
+            size = entry.stat().st_size
+            self._entries[entry.name] = size
+            self._total_bytes += size
+
+    def url(self, name):
+        """Return the URL a stored file is served at"""
+        return f"{self.url_path}/{name}"
+
+    def contains(self, url):
+        """Check that a URL returned by add() still serves its file, and mark it recently used.
+
+        Files are evicted by this store when it is full, and by other processes
+        sharing the folder, so a remembered URL can go stale.
+        """
+        name = url.rsplit("/", 1)[-1]
+        if not os.path.exists(os.path.join(self.directory, name)):
+            return False
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        return True
+
+    def add(self, data, extension):
+        """Store data unless it is already there, and return its URL"""
+        name = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+        path = os.path.join(self.directory, name)
+
+        with self._lock:
+            if name in self._entries and os.path.exists(path):
+                self._entries.move_to_end(name)
+                return self.url(name)
+
+        # Write to a temporary file first so the server never serves a partial file
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self._total_bytes -= previous
+            self._entries[name] = len(data)
+            self._total_bytes += len(data)
+            evicted = []
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_name, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                evicted.append(old_name)
+
+        for old_name in evicted:
+            try:
+                os.unlink(os.path.join(self.directory, old_name))
+            except FileNotFoundError:
+                pass
+        return self.url(name)
+
+    def stats(self):
+        """Return the number of stored files and their total size"""
+        with self._lock:
+            return {"files": len(self._entries), "bytes": self._total_bytes}
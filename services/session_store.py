@@ -0,0 +1,302 @@
+# Conversation storage shared by every app process
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    turn INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    meta TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (session_id, turn)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class SessionStore:
+    """Base class for session storage backends.
+
+    A session is an ordered list of messages ({"role", "content"} plus any extra
+    JSON-serializable fields), numbered by turn from 0, and a small dict of
+    settings. Messages are only ever appended or cut off at a turn, so backends
+    never rewrite a whole conversation.
+    """
+
+    name = "base"
+
+    def count_messages(self, session_id):
+        raise NotImplementedError
+
+    def load_messages(self, session_id, start=0, stop=None):
+        """Return messages[start:stop] of a session"""
+        raise NotImplementedError
+
+    def append_message(self, session_id, message):
+        """Add a message after the last one and return its turn"""
+        raise NotImplementedError
+
+    def truncate_messages(self, session_id, length):
+        """Delete every message from turn length on"""
+        raise NotImplementedError
+
+    def load_state(self, session_id):
+        """Return the session's saved settings, or {} for a new session"""
+        raise NotImplementedError
+
+    def save_state(self, session_id, state):
+        raise NotImplementedError
+
+    def delete_expired(self, max_age):
+        """Delete every session whose messages and settings are older than max_age seconds"""
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions kept in this process only, for tests and single-process setups"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._messages = {}  # session id -> list of messages
+        self._states = {}
+        self._updated = {}  # session id -> time of the last change
+
+    def count_messages(self, session_id):
+        with self._lock:
+            return len(self._messages.get(session_id, []))
+
+    def load_messages(self, session_id, start=0, stop=None):
+        with self._lock:
+            return [dict(message) for message in self._messages.get(session_id, [])[start:stop]]
+
+    def append_message(self, session_id, message):
+        with self._lock:
+            messages = self._messages.setdefault(session_id, [])
+            messages.append(dict(message))
+            self._updated[session_id] = time.time()
+            return len(messages) - 1
+
+    def truncate_messages(self, session_id, length):
+        with self._lock:
+            del self._messages.get(session_id, [])[length:]
+            self._updated[session_id] = time.time()
+
+    def load_state(self, session_id):
+        with self._lock:
+            return dict(self._states.get(session_id, {}))
+
+    def save_state(self, session_id, state):
+        with self._lock:
+            self._states[session_id] = dict(state)
+            self._updated[session_id] = time.time()
+
+    def delete_expired(self, max_age):
+        cutoff = time.time() - max_age
+        with self._lock:
+            for session_id in [session_id for session_id, updated in self._updated.items() if updated < cutoff]:
+                self._messages.pop(session_id, None)
+                self._states.pop(session_id, None)
+                del self._updated[session_id]
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a local SQLite database in WAL mode.
+
+    WAL lets any number of app processes on the machine read while one writes, so
+    a session can be served by whichever process the load balancer picks and
+    survives restarts. Messages are keyed by (session, turn), which is also the
+    index behind counting, paging and truncating them. Each thread gets its own
+    connection, since sqlite3 connections can't be shared between threads.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit, with explicit transactions where a write needs more than one statement
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            # Durable at every checkpoint, without an fsync per appended message
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def count_messages(self, session_id):
+        row = self._connection().execute(
+            "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0]
+
+    def load_messages(self, session_id, start=0, stop=None):
+        rows = self._connection().execute(
+            "SELECT role, content, meta FROM messages WHERE session_id = ? AND turn >= ? AND turn < ? ORDER BY turn",
+            (session_id, start, stop if stop is not None else 2 ** 62),
+        ).fetchall()
+        messages = []
+        for role, content, meta in rows:
+            message = {"role": role, "content": content}
+            if meta:
+                message.update(json.loads(meta))
+            messages.append(message)
+        return messages
+
+    def append_message(self, session_id, message):
+        extra = {key: value for key, value in message.items() if key not in ("role", "content")}
+        connection = self._connection()
+        # Take the write lock before picking the turn, so appends from two processes can't collide
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            (turn,) = connection.execute(
+                "SELECT COALESCE(MAX(turn) + 1, 0) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            connection.execute(
+                "INSERT INTO messages (session_id, turn, role, content, meta, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, turn, message["role"], message["content"],
+                 json.dumps(extra) if extra else None, time.time()),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return turn
+
+    def truncate_messages(self, session_id, length):
+        self._connection().execute("DELETE FROM messages WHERE session_id = ? AND turn >= ?", (session_id, length))
+
+    def load_state(self, session_id):
+        row = self._connection().execute(
+            "SELECT state FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_state(self, session_id, state):
+        self._connection().execute(
+            "INSERT INTO sessions (session_id, state, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (session_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+            (session_id, json.dumps(state), time.time()),
+        )
+
+    def delete_expired(self, max_age):
+        cutoff = time.time() - max_age
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # A session is active while either its latest message or its settings are recent
+            connection.execute(
+                "DELETE FROM messages WHERE session_id IN ("
+                "SELECT session_id FROM messages GROUP BY session_id HAVING MAX(created_at) < ?"
+                ") AND session_id NOT IN (SELECT session_id FROM sessions WHERE updated_at >= ?)",
+                (cutoff, cutoff),
+            )
+            connection.execute(
+                "DELETE FROM sessions WHERE updated_at < ? AND session_id NOT IN (SELECT session_id FROM messages)",
+                (cutoff,),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+
+class ConversationHistory:
+    """A session's messages, read from the store lazily and written through on change.
+
+    Supports what the app does with its message list: len(), indexing, slicing,
+    iteration and append(), plus truncate() and clear(). Only the latest page is
+    loaded at first; older messages are fetched a page at a time when something
+    reaches back for them.
+    """
+
+    def __init__(self, store, session_id, page_size=20):
+        self.store = store
+        self.session_id = session_id
+        self.page_size = page_size
+        self._length = store.count_messages(session_id)
+        self._loaded_from = self._length  # self._messages holds messages[_loaded_from:]
+        self._messages = []
+
+    def _load(self, start):
+        """Make sure messages[start:] are in memory"""
+        if start >= self._loaded_from:
+            return
+        start = max(0, min(start, self._loaded_from - self.page_size))
+        older = self.store.load_messages(self.session_id, start, self._loaded_from)
+        self._messages = older + self._messages
+        self._loaded_from = start
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            positions = range(start, stop, step)
+            if positions:
+                self._load(min(positions))
+            return [self._messages[position - self._loaded_from] for position in positions]
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("message index out of range")
+        self._load(index)
+        return self._messages[index - self._loaded_from]
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def append(self, message):
+        turn = self.store.append_message(self.session_id, message)
+        if turn != self._length:
+            # Another process added messages meanwhile, reload them when needed
+            self._messages = []
+            self._loaded_from = turn + 1
+        else:
+            self._messages.append(message)
+        self._length = turn + 1
+
+    def truncate(self, length):
+        """Drop every message from index length on"""
+        self.store.truncate_messages(self.session_id, length)
+        if length < self._loaded_from:
+            self._messages = []
+            self._loaded_from = length
+        else:
+            del self._messages[length - self._loaded_from:]
+        self._length = min(self._length, length)
+
+    def clear(self):
+        self.truncate(0)
+
+
+def create_session_store(name):
+    """Build the session store selected by name (sqlite or memory)"""
+    if name == "sqlite":
+        return SQLiteSessionStore(os.getenv("SESSION_DB_PATH", os.path.join(".cache", "sessions.db")))
+    if name == "memory":
+        return MemorySessionStore()
+    raise ValueError(f"Unknown session store: {name}")
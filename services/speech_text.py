@@ -0,0 +1,198 @@
+# Markdown to speakable text
+import re
+
+from services.context import CJK_CHARS
+
+# Line-level markdown, decided once per line from its start
+FENCE = re.compile(r'\s*(```|~~~)')
+RULE = re.compile(r'\s*([-*_])(\s*\1){2,}\s*$')
+TABLE_DIVIDER = re.compile(r'\s*\|?(\s*:?-+:?\s*\|)+\s*:?-*:?\s*$')
+LINE_PREFIX = re.compile(r'\s*(?:#{1,6}\s+|>\s*|[-*+]\s+|\d+[.)]\s+)*')
+
+# Inline markup that is dropped while its text is kept: code ticks, emphasis, strikethrough,
+# link and image brackets with their URL, and HTML tags. Asterisks between letters or digits
+# are left alone, so "2*3" is read as written. Every alternative starts with a literal
+# character, which lets the regex engine skip plain text quickly
+INLINE_MARKUP = re.compile(
+    r'``*|!\[|\[|\]\([^)\s]*\)|\]|\*(?:(?<![^\W_]\*)(?<!\*\*)\**|\**(?![^\W_]|\*))|~~'
+    r'|_(?<!\w_)_*|__*(?!\w)|</?[A-Za-z][^>\n]*>'
+)
+
+# Inline code spans, whose contents are spoken verbatim (split: text, ticks, code, text, ...)
+CODE_SPAN = re.compile(r'(`+)([^\n]+?)(?<!`)\1(?!`)')
+
+# A sentence ends at terminal punctuation plus any closing quotes or brackets, followed by
+# whitespace (so "3.5" is not split), right after full-width CJK punctuation, or at a line break
+SENTENCE_END = re.compile(r'(?=[.!?…。！？\n])(?:([.!?…]+["\'”’)\]]*)\s+|([。！？]+[”’」』）]*)\s*|\n)')
+
+# Boundaries in already speakable text, for splitting it into chunks
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?…。！？])\s+|(?<=[。！？])')
+
+# The same boundary in raw markdown, where emphasis may sit between the punctuation and the space
+RAW_SENTENCE_END = re.compile(r'[.!?…]+["\'”’)\]*_`~]*\s+|[。！？]+[”’」』）*_`~]*')
+
+# Lines starting with anything else are plain text and skip the line-level checks
+LINE_MARKUP_START = frozenset(' \t#>-*+_`~|0123456789')
+TERMINAL = ('.', '!', '?', '…', '。', '！', '？', '”', '’', '"', "'", ')', '」', '』', '）')
+
+
+def _strip_inline(text):
+    """Remove inline markup outside code spans"""
+    if "`" not in text:
+        return INLINE_MARKUP.sub("", text)
+    parts = CODE_SPAN.split(text)
+    return "".join(
+        INLINE_MARKUP.sub("", part) if i % 3 == 0 else part for i, part in enumerate(parts) if i % 3 != 1
+    )
+
+
+def _finish(sentence):
+    """End a sentence with punctuation so TTS pauses after it, full-width for CJK"""
+    if sentence.endswith(TERMINAL):
+        return sentence
+    return sentence + ("。" if CJK_CHARS.match(sentence[-1]) else ".")
+
+
+def join_sentences(sentences):
+    """Join sentences with a space, except after CJK punctuation where none is written"""
+    text = ""
+    for sentence in sentences:
+        if text and not text.endswith(("。", "！", "？", "」", "』", "）")):
+            text += " "
+        text += sentence
+    return text
+
+
+class SpeechTextNormalizer:
+    """Turn markdown into speakable sentences in one pass, chunk by chunk.
+
+    Complete lines are handled as they arrive: fenced code blocks, tables' divider
+    rows and horizontal rules are dropped, heading, list and quote markers are
+    stripped, and inline markup is removed with a single compiled pattern. An
+    unfinished line is processed up to its last sentence boundary, so a streaming
+    reply yields each sentence as soon as it is complete. Line breaks end sentences.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._sentence = ""
+        self._fence = None  # Fence marker while inside a code block
+        self._line_mode = None  # "speak" or "skip" once the start of the buffered line was handled
+
+    def _text(self, text, sentences):
+        """Add inline text (one or more lines), emitting every sentence it completes"""
+        parts = SENTENCE_END.split(_strip_inline(text))
+        parts[0] = self._sentence + parts[0]
+        # split() returns each sentence followed by the two groups of the boundary after it
+        for i in range(0, len(parts) - 1, 3):
+            sentence = " ".join((parts[i] + (parts[i + 1] or parts[i + 2] or "")).split())
+            if sentence:
+                sentences.append(_finish(sentence))
+        self._sentence = parts[-1]
+
+    def _line_start(self, line):
+        """Handle line-level markdown; returns the rest of the line to speak, or None"""
+        if self._fence is None and (not line or line[0] not in LINE_MARKUP_START):
+            return line
+
+        fence = FENCE.match(line)
+        if fence:
+            if self._fence is None:
+                self._fence = fence.group(1)
+            elif fence.group(1) == self._fence:
+                self._fence = None
+            return None
+        if self._fence is not None or RULE.match(line) or TABLE_DIVIDER.match(line):
+            return None
+
+        line = line[LINE_PREFIX.match(line).end():]
+        if line.lstrip().startswith("|"):
+            # Table row: read the cells as a list
+            line = ", ".join(cell.strip() for cell in line.strip().strip("|").split("|"))
+        return line
+
+    def _line(self, line):
+        """Return the speakable text of a complete line, or None"""
+        if self._line_mode is None:
+            line = self._line_start(line)
+        elif self._line_mode == "skip":
+            line = None
+        self._line_mode = None
+        return line
+
+    def feed(self, chunk):
+        """Add a chunk of markdown; returns the sentences it completes"""
+        sentences = []
+        self._buffer += chunk
+
+        *lines, self._buffer = self._buffer.split("\n")
+        if lines:
+            # Complete lines are cleaned and split together, each ending its sentence
+            speakable = [line for line in map(self._line, lines) if line is not None]
+            if speakable:
+                self._text("\n".join(speakable) + "\n", sentences)
+
+        # Speak the finished sentences of the line still being written, once its start is known
+        if self._line_mode == "speak" or (self._line_mode is None and len(self._buffer) >= 8):
+            end = None
+            for match in RAW_SENTENCE_END.finditer(self._buffer):
+                end = match.end()
+            if end is not None:
+                line = self._buffer[:end]
+                if self._line_mode is None:
+                    line = self._line_start(line)
+                    self._line_mode = "skip" if line is None else "speak"
+                if line is not None:
+                    self._text(line, sentences)
+                self._buffer = self._buffer[end:]
+        return sentences
+
+    def close(self):
+        """Finish the text; returns the remaining sentences"""
+        sentences = []
+        line = self._line(self._buffer) if self._buffer else None
+        if line is not None:
+            self._text(line, sentences)
+        sentence = " ".join(self._sentence.split())
+        if sentence:
+            sentences.append(_finish(sentence))
+        self._buffer = ""
+        self._sentence = ""
+        self._fence = None
+        return sentences
+
+
+def speech_sentences(text):
+    """Split markdown into speakable sentences"""
+    normalizer = SpeechTextNormalizer()
+    return normalizer.feed(text) + normalizer.close()
+
+
+def normalize_for_speech(text):
+    """Convert markdown to plain text for natural speech"""
+    return join_sentences(speech_sentences(text))
+
+
+def split_for_speech(text, max_chars):
+    """Split speakable text into chunks of at most max_chars, at sentence boundaries.
+
+    Sentences are packed together up to the limit; a single sentence longer than
+    that is split at its last comma or space before the limit (or hard if it has none).
+    """
+    sentences = []
+    for part in SENTENCE_SPLIT.split(text):
+        while len(part) > max_chars:
+            cut = max(part.rfind(", ", 0, max_chars), part.rfind(" ", 0, max_chars), part.rfind("，", 0, max_chars))
+            cut = cut + 1 if cut > 0 else max_chars
+            sentences.append(part[:cut].strip())
+            part = part[cut:].strip()
+        if part:
+            sentences.append(part)
+
+    chunks = []
+    for sentence in sentences:
+        if chunks and len(chunks[-1]) + 1 + len(sentence) <= max_chars:
+            chunks[-1] = join_sentences([chunks[-1], sentence])
+        else:
+            chunks.append(sentence)
+    return chunks
@@ -0,0 +1,174 @@
+# Speech-to-text engines
+import hashlib
+import json
+import os
+import threading
+import time
+
+import speech_recognition as sr
+
+
+class STTEngine:
+    """Base class for speech-to-text backends.
+
+    transcribe() takes sr.AudioData and returns the transcript, raising
+    sr.UnknownValueError when nothing intelligible was said and sr.RequestError
+    when the engine itself is unavailable.
+    """
+
+    name = "base"
+
+    def transcribe(self, audio_data, language_code):
+        raise NotImplementedError
+
+
+class GoogleSTTEngine(STTEngine):
+    """Google Web Speech API, one network round trip per utterance"""
+
+    name = "google"
+
+    def __init__(self):
+        self.recognizer = sr.Recognizer()
+
+    def transcribe(self, audio_data, language_code):
+        # show_all gives the alternatives ranked by confidence, or [] if nothing matched
+        result = self.recognizer.recognize_google(audio_data, language=language_code, show_all=True)
+        if not result or not result.get("alternative"):
+            raise sr.UnknownValueError()
+        return result["alternative"][0]["transcript"]
+
+
+class VoskSTTEngine(STTEngine):
+    """Offline CPU recognition with Vosk.
+
+    Models live in model_dir/<language code> (e.g. models/vosk/en-US) and are all
+    loaded up front, so the first utterance doesn't pay for it.
+    """
+
+    name = "vosk"
+    sample_rate = 16000
+
+    def __init__(self, model_dir):
+        try:
+            import vosk
+        except ImportError:
+            raise sr.RequestError("The local speech engine needs the vosk package (pip install vosk)")
+
+        vosk.SetLogLevel(-1)
+        self._vosk = vosk
+        self.model_dir = model_dir
+        self._models = {}
+        self._lock = threading.Lock()
+
+        if os.path.isdir(model_dir):
+            for language_code in sorted(os.listdir(model_dir)):
+                if os.path.isdir(os.path.join(model_dir, language_code)):
+                    self._models[language_code] = vosk.Model(os.path.join(model_dir, language_code))
+
+    def _model(self, language_code):
+        # Fall back from a regional code (es-ES) to a plain language model (es)
+        for candidate in (language_code, language_code.split("-")[0]):
+            if candidate in self._models:
+                return self._models[candidate]
+        with self._lock:
+            path = os.path.join(self.model_dir, language_code)
+            if not os.path.isdir(path):
+                raise sr.RequestError(f"No Vosk model for {language_code} in {self.model_dir}")
+            self._models[language_code] = self._vosk.Model(path)
+            return self._models[language_code]
+
+    def transcribe(self, audio_data, language_code):
+        pcm = audio_data.get_raw_data(convert_rate=self.sample_rate, convert_width=2)
+
+        # Models are shared, recognizers are cheap and per utterance
+        recognizer = self._vosk.KaldiRecognizer(self._model(language_code), self.sample_rate)
+        recognizer.AcceptWaveform(pcm)
+        text = json.loads(recognizer.FinalResult()).get("text", "")
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+
+class FakeSTTEngine(STTEngine):
+    """Deterministic engine for tests and offline runs.
+
+    Returns the configured transcript, or one derived from a hash of the audio so
+    the same recording always yields the same text.
+    """
+
+    name = "fake"
+
+    def __init__(self, transcript=None, latency=0.0):
+        self.transcript = transcript
+        self.latency = latency
+
+    def transcribe(self, audio_data, language_code):
+        if self.latency:
+            time.sleep(self.latency)
+        raw = audio_data.get_raw_data()
+        if not raw:
+            raise sr.UnknownValueError()
+        if self.transcript is not None:
+            return self.transcript
+        return f"test utterance {hashlib.sha1(raw).hexdigest()[:8]}"
+
+
+class IncrementalTranscriber:
+    """Transcribe the segments of one utterance in the background as they arrive.
+
+    Segments are independent recordings cut at pauses, so each can be recognized on
+    its own while the user keeps talking. When speech ends only the last segment is
+    still in flight.
+    """
+
+    def __init__(self, engine, language_code, executor, decode):
+        self.engine = engine
+        self.language_code = language_code
+        self.executor = executor
+        self.decode = decode
+        self._futures = {}  # segment index -> Future
+
+    def _transcribe(self, audio_bytes):
+        try:
+            return self.engine.transcribe(self.decode(audio_bytes), self.language_code)
+        except sr.UnknownValueError:
+            # Breaths and trailing silence become their own segments, skip them
+            return ""
+
+    def has_segment(self, index):
+        """Check whether a segment was already received"""
+        return index in self._futures
+
+    def add_segment(self, index, audio_bytes):
+        """Start transcribing a segment unless it was already received"""
+        if index not in self._futures:
+            self._futures[index] = self.executor.submit(self._transcribe, audio_bytes)
+
+    def partial_transcript(self):
+        """Return the text of the leading segments that are already transcribed"""
+        parts = []
+        for index in sorted(self._futures):
+            future = self._futures[index]
+            if not future.done() or future.exception() is not None:
+                break
+            parts.append(future.result())
+        return " ".join(part for part in parts if part)
+
+    def finish(self, timeout=None):
+        """Wait for every segment and return the full transcript"""
+        parts = [self._futures[index].result(timeout) for index in sorted(self._futures)]
+        text = " ".join(part for part in parts if part)
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+
+def create_stt_engine(name):
+    """Build the speech-to-text engine selected by name (google, vosk or fake)"""
+    if name == "google":
+        return GoogleSTTEngine()
+    if name == "vosk":
+        return VoskSTTEngine(os.getenv("VOSK_MODEL_DIR", os.path.join("models", "vosk")))
+    if name == "fake":
+        return FakeSTTEngine(os.getenv("FAKE_STT_TRANSCRIPT"), float(os.getenv("FAKE_STT_LATENCY", "0")))
+    raise ValueError(f"Unknown speech-to-text engine: {name}")
@@ -0,0 +1,196 @@
+# Per-turn latency tracing
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Tracer:
+    """Collect timed spans for the stages of each turn.
+
+    The most recent max_spans spans are kept for percentiles and export, while
+    per-stage counts and sums are cumulative for the lifetime of the process.
+    If log_path is set every span is also appended to it as a JSON line, by a
+    background thread, so recording a span never waits on the disk. Gauges
+    registered with add_gauge are read when metrics are exported.
+    """
+
+    def __init__(self, max_spans=5000, log_path=None):
+        self.log_path = log_path
+        self._spans = deque(maxlen=max_spans)
+        self._counts = defaultdict(int)
+        self._sums = defaultdict(float)
+        self._gauges = {}  # metric name -> (help text, function returning the current value)
+        self._lock = threading.Lock()
+        self._log_lines = None
+        if log_path:
+            self._log_lines = queue.SimpleQueue()
+            threading.Thread(target=self._write_log, name="trace-log", daemon=True).start()
+
+    def _write_log(self):
+        """Append queued lines to the log file, flushing whenever the queue runs dry"""
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            while True:
+                f.write(self._log_lines.get())
+                while not self._log_lines.empty():
+                    f.write(self._log_lines.get())
+                f.flush()
+
+    def record(self, name, duration, turn_id=None, session_id=None, **tags):
+        """Record a finished span of duration seconds"""
+        span = {
+            "name": name,
+            "duration": duration,
+            "end": time.time(),
+            "turn_id": turn_id,
+            "session_id": session_id,
+            **tags,
+        }
+        with self._lock:
+            self._spans.append(span)
+            self._counts[name] += 1
+            self._sums[name] += duration
+        if self._log_lines is not None:
+            self._log_lines.put(json.dumps(span, ensure_ascii=False) + "\n")
+
+    @contextmanager
+    def span(self, name, turn_id=None, session_id=None, **tags):
+        """Time the enclosed block as a span, tagging it with the exception type if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            tags["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, turn_id, session_id, **tags)
+
+    def wrap(self, name, func):
+        """Return func wrapped so every call is recorded as a span"""
+        def traced(*args, **kwargs):
+            with self.span(name):
+                return func(*args, **kwargs)
+        return traced
+
+    def add_gauge(self, name, help_text, read):
+        """Export read() as a Prometheus gauge called voice_assistant_<name>"""
+        with self._lock:
+            self._gauges[name] = (help_text, read)
+
+    def turn(self, session_id=None, **tags):
+        """Start tracing a new turn"""
+        return Turn(self, session_id, **tags)
+
+    def stage_summary(self):
+        """Return {stage: {"count", "p50", "p95"}} over the retained spans, in seconds"""
+        with self._lock:
+            durations = defaultdict(list)
+            for span in self._spans:
+                durations[span["name"]].append(span["duration"])
+        summary = {}
+        for name, values in sorted(durations.items()):
+            values.sort()
+            summary[name] = {
+                "count": len(values),
+                "p50": _percentile(values, 0.5),
+                "p95": _percentile(values, 0.95),
+            }
+        return summary
+
+    def to_jsonl(self):
+        """Export the retained spans as JSON lines"""
+        with self._lock:
+            spans = list(self._spans)
+        return "".join(json.dumps(span, ensure_ascii=False) + "\n" for span in spans)
+
+    def prometheus_text(self):
+        """Export per-stage latency as a Prometheus summary in the text exposition format"""
+        summary = self.stage_summary()
+        with self._lock:
+            counts = dict(self._counts)
+            sums = dict(self._sums)
+            gauges = dict(self._gauges)
+
+        lines = [
+            "# HELP voice_assistant_stage_seconds Duration of each stage of a conversation turn",
+            "# TYPE voice_assistant_stage_seconds summary",
+        ]
+        for name in sorted(counts):
+            stats = summary.get(name, {"p50": 0.0, "p95": 0.0})
+            lines.append(f'voice_assistant_stage_seconds{{stage="{name}",quantile="0.5"}} {stats["p50"]:.6f}')
+            lines.append(f'voice_assistant_stage_seconds{{stage="{name}",quantile="0.95"}} {stats["p95"]:.6f}')
+            lines.append(f'voice_assistant_stage_seconds_sum{{stage="{name}"}} {sums[name]:.6f}')
+            lines.append(f'voice_assistant_stage_seconds_count{{stage="{name}"}} {counts[name]}')
+        for name in sorted(gauges):
+            help_text, read = gauges[name]
+            lines.append(f"# HELP voice_assistant_{name} {help_text}")
+            lines.append(f"# TYPE voice_assistant_{name} gauge")
+            lines.append(f"voice_assistant_{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+
+class Turn:
+    """Spans belonging to one conversation turn, sharing its ID and tags"""
+
+    def __init__(self, tracer, session_id=None, **tags):
+        self.tracer = tracer
+        self.turn_id = uuid.uuid4().hex[:12]
+        self.session_id = session_id
+        self.tags = tags
+        self._start = time.perf_counter()
+
+    def span(self, name):
+        return self.tracer.span(name, self.turn_id, self.session_id, **self.tags)
+
+    def record(self, name, duration):
+        self.tracer.record(name, duration, self.turn_id, self.session_id, **self.tags)
+
+    def finish(self):
+        """Record the whole turn, from when it started until now"""
+        self.record("turn", time.perf_counter() - self._start)
+
+
+def start_metrics_server(tracer, port, host="127.0.0.1"):
+    """Serve /metrics (Prometheus text) and /spans (JSONL) from a background thread.
+
+    There is no authentication, so it only listens on the loopback interface unless
+    another host is given.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = tracer.prometheus_text()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/spans":
+                body = tracer.to_jsonl()
+                content_type = "application/x-ndjson; charset=utf-8"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would flood the Streamlit log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
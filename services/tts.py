@@ -0,0 +1,554 @@
+# Text-to-speech engines and helpers
+import hashlib
+import io
+import os
+import queue
+import tempfile
+import threading
+import time
+import wave
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from gtts import gTTS
+
+from services.audio import decode_audio, sniff_format
+from services.speech_text import SpeechTextNormalizer, join_sentences, split_for_speech
+
+# gTTS sends at most this many characters per request, one request after another
+GTTS_CHUNK_CHARS = 100
+
+def synthesize_speech(text, lang_code):
+    """Synthesize text with gTTS and return the MP3 bytes"""
+    tts = gTTS(text=text, lang=lang_code, slow=False)
+    audio_bytes = io.BytesIO()
+    tts.write_to_fp(audio_bytes)
+    return audio_bytes.getvalue()
+
+
+class TTSError(Exception):
+    """Raised when a text-to-speech engine is unavailable"""
+
+
+class TTSEngine:
+    """Base class for text-to-speech backends.
+
+    synthesize() takes speech text and a gTTS language code and returns MP3 or WAV
+    bytes; callers tell them apart with sniff_format(). Engines are callable, so
+    they can be passed wherever a synthesize function is expected.
+    """
+
+    name = "base"
+
+    def synthesize(self, text, lang_code):
+        raise NotImplementedError
+
+    def __call__(self, text, lang_code):
+        return self.synthesize(text, lang_code)
+
+
+class GTTSEngine(TTSEngine):
+    """Google Translate's speech endpoint through gTTS, one network round trip per 100 characters"""
+
+    name = "gtts"
+
+    def synthesize(self, text, lang_code):
+        return synthesize_speech(text, lang_code)
+
+
+class Pyttsx3TTSEngine(TTSEngine):
+    """Offline synthesis with pyttsx3 (eSpeak NG on Linux), producing WAV.
+
+    pyttsx3 engines are not thread-safe, so one engine is created on a dedicated
+    worker thread and kept warm there; synthesize() hands requests to it and waits.
+    """
+
+    name = "pyttsx3"
+
+    def __init__(self, rate=None):
+        self._requests = queue.Queue()
+        self._voices = {}  # language code -> voice id
+        ready = Future()
+        threading.Thread(target=self._run, args=(ready, rate), name="tts-pyttsx3", daemon=True).start()
+        # Fail here rather than on the first reply if eSpeak is missing
+        ready.result()
+
+    def _run(self, ready, rate):
+        try:
+            import pyttsx3
+            engine = pyttsx3.init()
+            if rate:
+                engine.setProperty("rate", rate)
+            voices = engine.getProperty("voices")
+        except Exception as e:
+            ready.set_exception(TTSError(f"The local speech engine needs pyttsx3 and eSpeak NG: {e}"))
+            return
+        ready.set_result(None)
+
+        while True:
+            text, lang_code, future = self._requests.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._synthesize(engine, voices, text, lang_code))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _voice(self, voices, lang_code):
+        """Pick the voice for a gTTS language code, preferring an exact regional match"""
+        if lang_code not in self._voices:
+            wanted = lang_code.lower().replace("_", "-")
+            candidates = {}
+            for voice in voices:
+                for language in voice.languages or []:
+                    if isinstance(language, bytes):
+                        # Older pyttsx3 returns eSpeak's raw entry: a priority byte, then the code
+                        language = language[1:].decode("latin-1")
+                    language = language.lower().replace("_", "-")
+                    candidates.setdefault(language, voice.id)
+                    candidates.setdefault(language.split("-")[0], voice.id)
+            voice_id = candidates.get(wanted) or candidates.get(wanted.split("-")[0])
+            if voice_id is None:
+                raise TTSError(f"No local voice for {lang_code}")
+            self._voices[lang_code] = voice_id
+        return self._voices[lang_code]
+
+    def _synthesize(self, engine, voices, text, lang_code):
+        engine.setProperty("voice", self._voice(voices, lang_code))
+        fd, path = tempfile.mkstemp(suffix=".wav", prefix="tts-")
+        os.close(fd)
+        try:
+            engine.save_to_file(text, path)
+            engine.runAndWait()
+            with open(path, "rb") as f:
+                data = f.read()
+        finally:
+            os.unlink(path)
+        if not data:
+            raise TTSError("The local speech engine produced no audio")
+        return data
+
+    def synthesize(self, text, lang_code):
+        future = Future()
+        self._requests.put((text, lang_code, future))
+        return future.result()
+
+
+class FakeTTSEngine(TTSEngine):
+    """Offline stand-in for gTTS with a fixed artificial latency.
+
+    The returned bytes are a placeholder, not playable audio.
+    """
+
+    name = "fake"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def synthesize(self, text, lang_code):
+        if self.latency:
+            time.sleep(self.latency)
+        return f"FAKE-MP3:{lang_code}:{text}".encode("utf-8")
+
+
+class FallbackTTSEngine(TTSEngine):
+    """Try several engines in turn, skipping ones that recently failed.
+
+    Engines are tried in the given order, or fastest first when by_latency is set
+    (a moving average of each engine's call time; engines without a measurement
+    yet are tried first so every one gets measured). A failed engine is skipped
+    for cooldown seconds.
+    """
+
+    def __init__(self, engines, name="auto", by_latency=False, cooldown=60.0, smoothing=0.2):
+        self.engines = list(engines)
+        self.name = name
+        self.by_latency = by_latency
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._latency = {}  # engine name -> average seconds per call
+        self._failed_until = {}  # engine name -> time.monotonic() until which it is skipped
+
+    def _candidates(self):
+        now = time.monotonic()
+        with self._lock:
+            healthy = [engine for engine in self.engines if self._failed_until.get(engine.name, 0) <= now]
+            if self.by_latency:
+                healthy.sort(key=lambda engine: self._latency.get(engine.name, 0.0))
+        # If everything failed recently, trying again beats giving up
+        return healthy or list(self.engines)
+
+    def synthesize(self, text, lang_code):
+        error = None
+        for engine in self._candidates():
+            start = time.perf_counter()
+            try:
+                data = engine.synthesize(text, lang_code)
+            except Exception as e:
+                error = e
+                with self._lock:
+                    self._failed_until[engine.name] = time.monotonic() + self.cooldown
+                continue
+
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                previous = self._latency.get(engine.name)
+                self._latency[engine.name] = elapsed if previous is None else (
+                    previous + self.smoothing * (elapsed - previous))
+                self._failed_until.pop(engine.name, None)
+            return data
+        raise error
+
+    def stats(self):
+        """Return {engine name: {"latency", "available"}}, latency in seconds or None"""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                engine.name: {
+                    "latency": self._latency.get(engine.name),
+                    "available": self._failed_until.get(engine.name, 0) <= now,
+                }
+                for engine in self.engines
+            }
+
+
+def create_tts_engine(name):
+    """Build the text-to-speech engine selected by name.
+
+    gtts, pyttsx3 (offline) or fake (tests), or auto (gTTS, falling back to
+    pyttsx3) and fastest (whichever of the two has been quicker lately).
+    """
+    if name == "gtts":
+        return GTTSEngine()
+    if name == "pyttsx3":
+        return Pyttsx3TTSEngine(int(os.getenv("PYTTSX3_RATE", "0")) or None)
+    if name in ("auto", "fastest"):
+        engines = [GTTSEngine()]
+        try:
+            engines.append(Pyttsx3TTSEngine(int(os.getenv("PYTTSX3_RATE", "0")) or None))
+        except TTSError:
+            # No local engine on this machine, gTTS only
+            pass
+        return FallbackTTSEngine(engines, name=name, by_latency=name == "fastest")
+    if name == "fake":
+        return FakeTTSEngine(float(os.getenv("FAKE_TTS_LATENCY", "0")))
+    raise ValueError(f"Unknown text-to-speech engine: {name}")
+
+
+def _wav_bytes(frames, sample_rate, sample_width, channels):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(sample_width)
+        wav.setframerate(sample_rate)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+def join_audio(segments):
+    """Join synthesized audio segments into one playable clip.
+
+    MP3 is a sequence of self-contained frames, so MP3 segments are simply
+    concatenated. WAV segments with the same format have their samples joined under
+    one header. A mix of formats (an engine fell back halfway through) is decoded
+    to 16 kHz PCM and joined as WAV.
+    """
+    segments = [segment for segment in segments if segment]
+    formats = [sniff_format(segment) for segment in segments]
+    if "wav" not in formats:
+        return b"".join(segments)
+
+    if all(audio_format == "wav" for audio_format in formats):
+        params = set()
+        frames = []
+        for segment in segments:
+            with wave.open(io.BytesIO(segment), "rb") as wav:
+                params.add((wav.getframerate(), wav.getsampwidth(), wav.getnchannels()))
+                frames.append(wav.readframes(wav.getnframes()))
+        if len(params) == 1:
+            return _wav_bytes(b"".join(frames), *params.pop())
+
+    decoded = [decode_audio(segment) for segment in segments]
+    return _wav_bytes(b"".join(audio.get_raw_data() for audio in decoded), decoded[0].sample_rate, 2, 1)
+
+
+class ChunkedSynthesizer:
+    """Synthesize long text as sentence-sized chunks in parallel and join the audio.
+
+    gTTS splits long text into ~100-character requests and sends them one after
+    another, so a long reply takes as long as all its requests together. Works
+    with any engine; the local one runs chunks one at a time on its own thread. Here each
+    chunk is a separate call on the executor, and the wall-clock time is close to
+    that of the slowest chunk. The executor must not be the one running the calls
+    to this synthesizer, or they could deadlock waiting on their own chunks.
+    """
+
+    def __init__(self, synthesize, executor, max_chars=GTTS_CHUNK_CHARS):
+        self.synthesize = synthesize
+        self.executor = executor
+        self.max_chars = max_chars
+
+    def __call__(self, text, lang_code):
+        chunks = split_for_speech(text, self.max_chars)
+        if len(chunks) <= 1:
+            return self.synthesize(text, lang_code)
+        futures = [self.executor.submit(self.synthesize, chunk, lang_code) for chunk in chunks]
+        return join_audio([future.result() for future in futures])
+
+
+class TTSCache:
+    """Disk-backed, content-addressed cache of synthesized speech with LRU eviction.
+
+    Entries are keyed by a hash of the speech text, language and voice, so identical
+    phrases are synthesized once for every session and process sharing the directory.
+    Files are named <key>.mp3 or <key>.wav after the audio they hold.
+    """
+
+    extensions = ("mp3", "wav")
+
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self._total_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        existing = [
+            entry for entry in os.scandir(directory)
+            if entry.name.rpartition(".")[2] in self.extensions
+        ]
+        for entry in sorted(existing, key=lambda e: e.stat().st_mtime):
+            size = entry.stat().st_size
+            self._entries[entry.name.partition(".")[0]] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def make_key(text, lang_code, voice="gtts"):
+        """Build the cache key for a piece of speech text"""
+        return hashlib.sha256(f"{voice}\0{lang_code}\0{text}".encode("utf-8")).hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def _find(self, key):
+        """Return the path of key's file, or None if it isn't cached"""
+        for extension in self.extensions:
+            path = self._path(key, extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def contains(self, key):
+        """Check whether key is cached without counting a hit or miss"""
+        return self._find(key) is not None
+
+    def get(self, key):
+        """Return the cached audio for key, or None on a miss"""
+        path = self._find(key)
+        data = None
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+        if data is None:
+            with self._lock:
+                self.misses += 1
+                # Another process may have evicted it
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+
+        # Bump the modification time so LRU order survives restarts
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                self._entries[key] = len(data)
+                self._total_bytes += len(data)
+        return data
+
+    def put(self, key, data):
+        """Store audio under key, evicting least recently used entries if over budget"""
+        path = self._path(key, "wav" if sniff_format(data) == "wav" else "mp3")
+        # Write to a temporary file first so readers never see a partial entry
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            evicted = []
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            for extension in self.extensions:
+                try:
+                    os.unlink(self._path(old_key, extension))
+                except FileNotFoundError:
+                    pass
+
+    def get_or_create(self, text, lang_code, synthesize, voice="gtts"):
+        """Return cached audio for text, synthesizing and storing it on a miss"""
+        key = self.make_key(text, lang_code, voice)
+        data = self.get(key)
+        if data is None:
+            data = synthesize(text, lang_code)
+            self.put(key, data)
+        return data
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+            }
+
+
+class TTSJobQueue:
+    """Background TTS jobs on a shared executor, deduplicated by cache key.
+
+    Jobs write their result into the cache, so a finished job is visible to every
+    session. At most max_pending jobs may be queued or running at once.
+    """
+
+    def __init__(self, cache, executor, synthesize=synthesize_speech, voice="gtts", max_pending=16):
+        self.cache = cache
+        self.executor = executor
+        self.synthesize = synthesize
+        self.voice = voice
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._jobs = {}  # key -> Future
+
+    def key(self, text, lang_code):
+        """Return the cache key of text spoken by this queue's voice"""
+        return self.cache.make_key(text, lang_code, self.voice)
+
+    def submit(self, text, lang_code):
+        """Queue synthesis of text unless it is cached or already queued, and return its status"""
+        key = self.key(text, lang_code)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and not job.done():
+                return "pending"
+            if job is not None and job.exception() is None:
+                return "ready"
+            if self.cache.contains(key):
+                return "ready"
+            pending = sum(1 for future in self._jobs.values() if not future.done())
+            if pending >= self.max_pending:
+                return "busy"
+            self._jobs[key] = self.executor.submit(
+                self.cache.get_or_create, text, lang_code, self.synthesize, self.voice)
+        return "pending"
+
+    def status(self, key):
+        """Return "pending", "ready", "failed", or None if nothing was requested for key"""
+        job = self._jobs.get(key)
+        if job is None:
+            return "ready" if self.cache.contains(key) else None
+        if not job.done():
+            return "pending"
+        if job.exception() is not None:
+            return "failed"
+        # The audio now lives in the cache, no need to keep the job around
+        with self._lock:
+            self._jobs.pop(key, None)
+        return "ready"
+
+    def error(self, key):
+        """Return the exception of a failed job, if any"""
+        job = self._jobs.get(key)
+        if job is not None and job.done():
+            return job.exception()
+        return None
+
+
+class SpeechPipeline:
+    """Split a streaming reply into sentences and synthesize them while the rest is still arriving.
+
+    The reply's markdown is normalized for speech as it streams in, and each complete
+    sentence is submitted to the executor as soon as its boundary is seen, so by the time the reply finishes most of it is already spoken
+    audio. Segments are returned in reply order regardless of which finishes first.
+    """
+
+    def __init__(self, lang_code, executor, min_chars=40, cache=None, synthesize=synthesize_speech,
+                 voice="gtts"):
+        self.lang_code = lang_code
+        self.executor = executor
+        self.cache = cache
+        self.synthesize = synthesize
+        self.voice = voice
+        self.min_chars = min_chars
+        self._normalizer = SpeechTextNormalizer()
+        self._pending = []
+        self._futures = []
+
+    def _submit(self, sentences):
+        text = join_sentences(sentences)
+        if not text:
+            return
+        if self.cache is not None:
+            future = self.executor.submit(
+                self.cache.get_or_create, text, self.lang_code, self.synthesize, self.voice)
+        else:
+            future = self.executor.submit(self.synthesize, text, self.lang_code)
+        self._futures.append(future)
+
+    def feed(self, chunk):
+        """Add a chunk of reply text and start synthesizing any sentences it completes"""
+        for sentence in self._normalizer.feed(chunk):
+            # Merge very short sentences so we don't pay a request for "Sure!"
+            self._pending.append(sentence)
+            if sum(len(pending) for pending in self._pending) >= self.min_chars:
+                self._submit(self._pending)
+                self._pending = []
+
+    def close(self):
+        """Flush whatever text is left once the reply has finished"""
+        remainder = self._pending + self._normalizer.close()
+        self._pending = []
+        self._submit(remainder)
+
+    def ready_segments(self):
+        """Return the segments synthesized so far, in reply order, up to the first one still running"""
+        ready = []
+        for future in list(self._futures):
+            if not future.done() or future.exception() is not None:
+                break
+            ready.append(future.result())
+        return ready
+
+    def segments(self):
+        """Yield the synthesized audio segments in reply order"""
+        for future in self._futures:
+            yield future.result()
+
+    def audio(self):
+        """Return all segments joined into a single clip"""
+        return join_audio(self.segments())
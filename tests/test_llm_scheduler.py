@@ -0,0 +1,107 @@
+"""RequestScheduler behaviour against the offline fake model: merging, stopping, retries and failures."""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.llm import FakeGenerativeModel, RequestScheduler, TransientLLMError, request_key  # noqa: E402
+
+
+def flaky(failures, error_type=TransientLLMError):
+    """Return a function that raises error_type on its first failures calls, then answers"""
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) <= failures:
+            raise error_type("injected failure")
+        return "ok"
+
+    func.calls = calls
+    return func
+
+
+def test_identical_concurrent_requests_share_one_call():
+    model = FakeGenerativeModel(chunk_delay=0.02)
+    scheduler = RequestScheduler(max_in_flight=4)
+    key = request_key("system", [], "Hello there")
+    first_chat, second_chat = model.start_chat(), model.start_chat()
+
+    first = scheduler.stream(first_chat, "Hello there", key)
+    first_text = next(first)
+    # The first request is still streaming, so the second one joins it
+    second_text = "".join(scheduler.stream(second_chat, "Hello there", key))
+    first_text += "".join(first)
+
+    assert first_text == second_text == "You said: Hello there. This is a test reply."
+    assert model.calls == 1
+    stats = scheduler.stats()
+    assert stats["requests"] == 1
+    assert stats["coalesced"] == 1
+    # The exchange is recorded in the chat that didn't make the call as well
+    assert second_chat.history == first_chat.history
+
+
+def test_different_requests_are_not_merged():
+    model = FakeGenerativeModel()
+    scheduler = RequestScheduler()
+
+    for prompt in ("Hello", "Goodbye"):
+        scheduler.send(model.start_chat(), prompt, request_key("system", [], prompt))
+
+    assert model.calls == 2
+    assert scheduler.stats()["coalesced"] == 0
+
+
+def test_stopped_stream_frees_its_slot():
+    model = FakeGenerativeModel(chunk_delay=0.02, reply=" ".join(["word"] * 100))
+    scheduler = RequestScheduler(max_in_flight=1)
+
+    reply = scheduler.stream(model.start_chat(), "Hello")
+    next(reply)
+    reply.close()
+    # The worker stops at the stream's next chunk instead of reading the other 99
+    deadline = time.monotonic() + 1.0
+    while scheduler.stats()["in_flight"] and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+    stats = scheduler.stats()
+    assert stats["in_flight"] == 0
+    assert stats["abandoned"] == 1
+    assert stats["failures"] == 0
+
+
+def test_transient_errors_are_retried():
+    scheduler = RequestScheduler(max_retries=3, backoff=0.0)
+    func = flaky(2)
+
+    assert scheduler.call(func) == "ok"
+    assert len(func.calls) == 3
+    stats = scheduler.stats()
+    assert stats["retries"] == 2
+    assert stats["failures"] == 0
+
+
+def test_transient_errors_give_up_after_max_retries():
+    model = FakeGenerativeModel(failure_rate=1.0)
+    scheduler = RequestScheduler(max_retries=2, backoff=0.0)
+
+    with pytest.raises(TransientLLMError):
+        scheduler.send(model.start_chat(), "Hello")
+    assert model.calls == 3
+    assert scheduler.stats()["failures"] == 1
+
+
+def test_other_errors_are_raised_without_retrying():
+    scheduler = RequestScheduler(max_retries=3, backoff=0.0)
+    func = flaky(1, ValueError)
+
+    with pytest.raises(ValueError):
+        scheduler.call(func)
+    assert len(func.calls) == 1
+    stats = scheduler.stats()
+    assert stats["retries"] == 0
+    assert stats["failures"] == 1